@@ -0,0 +1,349 @@
+#!/usr/bin/env python
+# coding: utf-8
+"""
+Offline build and benchmark of the OpenResty docset.
+
+    ./bench.py record    record every doc's page and resources from GitHub
+    ./bench.py serve     replay the recorded corpus as a local GitHub stand-in
+    ./bench.py run       benchmark the build against the stand-in
+"""
+from __future__ import print_function
+from threading import Thread
+import argparse
+import hashlib
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+try:
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+except ImportError:
+    print("bench.py requires Python 3.7+")
+    sys.exit(1)
+
+import openresty
+
+CORPUS = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+
+def corpus_key(url):
+    """Path of url on the stand-in server, e.g. /github.com/openresty/..."""
+    return '/' + url.split('://', 1)[-1]
+
+
+class Corpus(object):
+    """
+    Recorded responses, one file per url, with an index mapping each
+    stand-in path to its file and content type.
+    """
+
+    def __init__(self, path=CORPUS):
+        self.path = path
+        self.index = {}
+        index_path = os.path.join(path, 'index.json')
+        if os.path.isfile(index_path):
+            with open(index_path) as f:
+                self.index = json.load(f)
+
+    def add(self, url, content, content_type):
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        key = corpus_key(url)
+        fn = hashlib.sha1(key.encode('utf-8')).hexdigest()
+        with open(os.path.join(self.path, fn), 'wb') as f:
+            f.write(content)
+        self.index[key] = {'file': fn, 'type': content_type}
+
+    def get(self, key):
+        """Return (content, content type) recorded for key, or None."""
+        record = self.index.get(key)
+        if record is None:
+            return None
+        with open(os.path.join(self.path, record['file']), 'rb') as f:
+            return f.read(), record['type']
+
+    def pages(self):
+        """Yield (doc, html) of every doc in the corpus."""
+        for doc in openresty.DOCS:
+            recorded = self.get(corpus_key(doc.url))
+            if recorded is None:
+                raise KeyError('%s is not recorded' % doc.url)
+            doc = doc.copy()
+            doc.reassign_name()
+            yield doc, recorded[0].decode('utf-8')
+
+    def save(self):
+        with open(os.path.join(self.path, 'index.json'), 'w') as f:
+            json.dump(self.index, f, indent=1, sort_keys=True)
+
+
+def record(args):
+    corpus = Corpus(args.corpus)
+    session = openresty.create_session()
+
+    def fetch(url):
+        res = session.get(url)
+        res.raise_for_status()
+        corpus.add(url, res.content, res.headers.get('Content-Type', ''))
+        return res
+
+    resources = set()
+    for doc in openresty.DOCS:
+        print('Record %s' % doc.url)
+        html = fetch(doc.url).text
+        doc.reassign_name()
+        resources |= openresty.parse_doc_from_html(html, doc)[1]
+    for url in sorted(set(res.url for res in resources)):
+        print('Record %s' % url)
+        fetch(url)
+    # polled by watch.py
+    for repo, ref in sorted(set((doc.repo, doc.ref) for doc in openresty.DOCS)):
+        url = openresty.HEAD_URL.format(repo=repo, ref=ref)
+        print('Record %s' % url)
+        fetch(url)
+    corpus.save()
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    """Replay the corpus with the configured latency and bandwidth."""
+    protocol_version = 'HTTP/1.1'
+    # headers and body are written separately
+    disable_nagle_algorithm = True
+    corpus = None
+    # seconds before each response
+    latency = 0
+    # bytes per second, 0 means unlimited
+    bandwidth = 0
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        time.sleep(self.latency)
+        recorded = self.corpus.get(self.path)
+        if recorded is None:
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        content, content_type = recorded
+        etag = '"%s"' % hashlib.sha1(content).hexdigest()
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('ETag', etag)
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        if not self.bandwidth:
+            self.wfile.write(content)
+            return
+        chunk = max(1, self.bandwidth // 10)
+        for start in range(0, len(content), chunk):
+            self.wfile.write(content[start:start + chunk])
+            time.sleep(0.1)
+
+
+def start_stand_in(corpus, port=0, latency=0, bandwidth=0):
+    """Serve the corpus in a background thread, return the server."""
+    handler = type(
+        'Handler', (StandInHandler, ), {
+            'corpus': corpus,
+            'latency': latency,
+            'bandwidth': bandwidth
+        })
+    server = ThreadingHTTPServer(('127.0.0.1', port), handler)
+    server.daemon_threads = True
+    thread = Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def server_url(server):
+    return 'http://%s:%d' % server.server_address
+
+
+def serve(args):
+    server = start_stand_in(
+        Corpus(args.corpus), args.port, args.latency / 1000.0,
+        args.bandwidth * 1024)
+    print('Serving %s at %s' % (args.corpus, server_url(server)))
+    print('Build with `./openresty.py --upstream %s`' % server_url(server))
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+def bench_parse(corpus, parser):
+    """Return (seconds, bytes, parsed docs) of parsing every page."""
+    seconds = 0.0
+    size = 0
+    results = []
+    for doc, html in corpus.pages():
+        start = time.time()
+        results.append(openresty.parse_doc_from_html(html, doc, parser))
+        seconds += time.time() - start
+        size += len(html.encode('utf-8'))
+    return seconds, size, results
+
+
+def bench_insert(entries, workdir):
+    fn = os.path.join(workdir, 'docSet.dsidx')
+    openresty.write_sql_schema(fn)
+    start = time.time()
+    openresty.insert_entries(entries, fn)
+    db = openresty.connect_index(fn)
+    with db:
+        openresty.mark_duplicate_entries(db)
+    db.close()
+    return time.time() - start
+
+
+def bench_download(resources, workdir, fetcher):
+    path = os.path.join(workdir, 'Documents') + '/'
+    os.makedirs(path)
+    start = time.time()
+    openresty.download_resources(resources, path, fetcher)
+    size = sum(os.path.getsize(path + fn) for fn in os.listdir(path))
+    return time.time() - start, size
+
+
+def bench_build(upstream, workdir, build_args):
+    """Run a whole build in a child process, return (seconds, peak RSS)."""
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          'openresty.py')
+    cmd = [sys.executable, script, '--upstream', upstream, '--no-cache']
+    start = time.time()
+    with open(os.devnull, 'w') as devnull:
+        subprocess.check_call(
+            cmd + build_args, cwd=workdir, stdout=devnull)
+    seconds = time.time() - start
+    peak = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    if sys.platform != 'darwin':
+        peak *= 1024
+    return seconds, peak
+
+
+def run(args):
+    corpus = Corpus(args.corpus)
+    server = start_stand_in(corpus, 0, args.latency / 1000.0,
+                            args.bandwidth * 1024)
+    fetcher = openresty.Fetcher(upstream=server_url(server))
+    workdir = tempfile.mkdtemp(prefix='openresty-bench-')
+    report = {'parse': {}}
+    try:
+        for parser in args.parsers:
+            seconds, size, results = bench_parse(corpus, parser)
+            report['parse'][parser] = {
+                'seconds': seconds,
+                'bytes': size,
+                'mb_per_second': size / seconds / 1024 / 1024,
+            }
+        entries = [entry for result in results for entry in result[0]]
+        resources = set(res for result in results for res in result[1])
+        report['insert_entries'] = {
+            'seconds': bench_insert(entries, workdir),
+            'entries': len(entries),
+        }
+        seconds, size = bench_download(resources, workdir, fetcher)
+        report['download_resources'] = {
+            'seconds': seconds,
+            'resources': len(resources),
+            'bytes': size,
+        }
+        seconds, peak = bench_build(
+            server_url(server), workdir, args.build_args)
+        report['build'] = {'seconds': seconds, 'peak_rss': peak}
+    finally:
+        server.shutdown()
+        shutil.rmtree(workdir)
+
+    if args.json:
+        print(json.dumps(report, indent=2, sort_keys=True))
+        return
+    for parser, result in sorted(report['parse'].items()):
+        print('parse (%s): %.3fs, %.2f MB/s' %
+              (parser, result['seconds'], result['mb_per_second']))
+    print('insert_entries: %.3fs, %d entries' %
+          (report['insert_entries']['seconds'],
+           report['insert_entries']['entries']))
+    print('download_resources: %.3fs, %d resources, %d bytes' %
+          (report['download_resources']['seconds'],
+           report['download_resources']['resources'],
+           report['download_resources']['bytes']))
+    print('build: %.3fs, peak RSS %.1f MB' %
+          (report['build']['seconds'],
+           report['build']['peak_rss'] / 1024.0 / 1024))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Offline build and benchmark of the OpenResty docset.')
+    parser.add_argument(
+        '--corpus', default=CORPUS, help='where the recorded corpus lives')
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+
+    record_parser = commands.add_parser(
+        'record', help='record every doc and its resources from GitHub')
+    record_parser.set_defaults(func=record)
+
+    for name, func, help in (
+        ('serve', serve, 'replay the corpus as a local GitHub stand-in'),
+        ('run', run, 'benchmark the build against the stand-in'),
+    ):
+        sub = commands.add_parser(name, help=help)
+        sub.add_argument(
+            '--latency',
+            type=float,
+            default=0,
+            help='milliseconds to wait before each response')
+        sub.add_argument(
+            '--bandwidth',
+            type=int,
+            default=0,
+            help='KB/s of each response, unlimited by default')
+        sub.set_defaults(func=func)
+        if name == 'serve':
+            sub.add_argument('--port', type=int, default=8000)
+        else:
+            sub.add_argument(
+                '--parsers',
+                nargs='+',
+                default=['html.parser'],
+                choices=openresty.PARSERS,
+                help='parser backends to measure, the last one is used for '
+                'the other stages')
+            sub.add_argument(
+                '--json', action='store_true', help='print a JSON report')
+            sub.add_argument(
+                'build_args',
+                nargs=argparse.REMAINDER,
+                help='arguments passed to openresty.py, after --')
+
+    args = parser.parse_args()
+    if getattr(args, 'build_args', None) and args.build_args[0] == '--':
+        args.build_args = args.build_args[1:]
+    if args.command != 'record' and not Corpus(args.corpus).index:
+        # the corpus isn't part of the repo
+        print('No corpus in %s, record one first with `./bench.py record`' %
+              args.corpus)
+        sys.exit(1)
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
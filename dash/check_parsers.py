@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Check that all parser backends generate the same docset
+from __future__ import print_function
+import argparse
+import os
+import sys
+import time
+
+import openresty
+
+try:
+    from lxml import html as lxml_html
+except ImportError:
+    lxml_html = None
+
+
+def canonical(html):
+    """
+    Turn generated html into a comparable tree of
+    (tag, attributes, text, children, tail), so that different ways of
+    serializing the same document compare equal.
+    """
+    def walk(element):
+        tag = element.tag if isinstance(element.tag, str) else '<!---->'
+        return (tag, sorted(element.attrib.items()), element.text or '',
+                [walk(child) for child in element], element.tail or '')
+
+    return walk(lxml_html.document_fromstring(html))
+
+
+def first_difference(a, b, path=''):
+    path += '/' + a[0]
+    for field, x, y in zip(('tag', 'attributes', 'text'), a, b):
+        if x != y:
+            return '%s %s: %r vs %r' % (path, field, x, y)
+    if len(a[3]) != len(b[3]):
+        return '%s: %d vs %d children' % (path, len(a[3]), len(b[3]))
+    for child_a, child_b in zip(a[3], b[3]):
+        diff = first_difference(child_a, child_b, path)
+        if diff is not None:
+            return diff
+    if a[4] != b[4]:
+        return '%s tail: %r vs %r' % (path, a[4], b[4])
+    return None
+
+
+def check_doc(doc, html, parsers, timings):
+    """Return the list of differences between each parser and the first one."""
+    results = {}
+    for parser in parsers:
+        start = time.time()
+        results[parser] = openresty.parse_doc_from_html(html, doc, parser)
+        timings[parser] += time.time() - start
+    problems = []
+    base = parsers[0]
+    entries, resources, text = results[base]
+    tree = canonical(text)
+    for parser in parsers[1:]:
+        other_entries, other_resources, other_text = results[parser]
+        if entries != other_entries:
+            problems.append('%s entries: %d vs %d, first different: %s' % (
+                parser, len(entries), len(other_entries),
+                next((pair for pair in zip(entries, other_entries)
+                      if pair[0] != pair[1]), None)))
+        if resources != other_resources:
+            problems.append('%s resources: %s' %
+                            (parser, resources ^ other_resources))
+        diff = first_difference(tree, canonical(other_text))
+        if diff is not None:
+            problems.append('%s html: %s' % (parser, diff))
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Check that all parser backends produce identical '
+        'entries, resources and html for every doc.')
+    parser.add_argument(
+        '--parsers',
+        nargs='+',
+        default=list(openresty.PARSERS),
+        choices=openresty.PARSERS,
+        help='backends to compare, the first one is the reference')
+    parser.add_argument(
+        '--cache-dir',
+        default='.cache',
+        help='response cache shared with openresty.py')
+    parser.add_argument(
+        '--upstream',
+        help='fetch every url from UPSTREAM/host/path instead, '
+        'e.g. a server started by `bench.py serve`')
+    args = parser.parse_args()
+    if lxml_html is None:
+        # the lxml backends and the comparison of the pages need it
+        print("lxml not found, run `pip install lxml` to check the parsers")
+        sys.exit(1)
+
+    fetcher = openresty.Fetcher(
+        cache=openresty.ResponseCache(
+            os.path.join(args.cache_dir, 'http'), 256 * 1024 * 1024),
+        upstream=args.upstream)
+    timings = dict((parser, 0.0) for parser in args.parsers)
+    failed = 0
+    for doc in openresty.DOCS:
+        html = fetcher.get_text(doc.url)
+        doc.reassign_name()
+        problems = check_doc(doc, html, args.parsers, timings)
+        if problems:
+            failed += 1
+            print('%s: FAILED' % doc.name)
+            for problem in problems:
+                print('\t' + problem)
+        else:
+            print('%s: OK' % doc.name)
+    fetcher.cache.save()
+    print('')
+    for parser in args.parsers:
+        print('%-12s %.3fs' % (parser, timings[parser]))
+    if failed:
+        print('%d docs differ' % failed)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,73 +1,163 @@
 #!/usr/bin/env python
 # coding: utf-8
 
-# Diff entries from two sqlite3 db
-import os
+# Diff entries from two or more sqlite3 db
+from __future__ import print_function
+from itertools import groupby
+import argparse
+import json
 import sqlite3
-import sys
 
+# The doc of an entry is the part of its path before '.html', or before '/'
+# for the pages of split docs, as in openresty.mark_duplicate_entries
+END = "instr(replace(path, '/', '.html'), '.html')"
+DOC = "CASE WHEN {0} > 0 THEN substr(path, 1, {0} - 1) ELSE path END".format(
+    END)
 
-def get_entries(db_name):
-    db = sqlite3.connect(db_name)
-    cur = db.cursor()
-    cur.execute("SELECT name, type, path from searchIndex")
-    entries = cur.fetchall()
-    db.commit()
-    db.close()
-    return set(entries)
-
-
-def diff(old, new):
-    add = new - old
-    rem = old - new
-    print("Added: %d" % len(add))
-    print_merged_entries(add)
-    print("Removed: %d" % len(rem))
-    print_merged_entries(rem)
-
-
-def print_merged_entries(entries):
-    size = len(entries)
-    if size == 0:
-        return
-    entries = sorted(entries, key=lambda x: x[2])
-    entries_in_previous_doc = []
-    current_doc = entries[0][2].split('#')[0]
-    start = 0
-    for i in range(size + 1):
-        if i < size:
-            doc_name, _ = entries[i][2].split('#')
-            # Only print when new doc is met or the last doc is met
-            if doc_name == current_doc:
+
+def store_changes(db, table, old, new):
+    """
+    Store the entries of the attached db `new` which aren't in `old`, None
+    for an empty db, into the temp table. Both sides are ordered like their
+    unique index, so sqlite merges the two indexes instead of sorting the
+    whole dbs.
+    """
+    db.execute('DROP TABLE IF EXISTS temp.%s' % table)
+    query = 'SELECT name, type, path FROM %s.searchIndex' % new
+    if old is not None:
+        query += ' EXCEPT SELECT name, type, path FROM %s.searchIndex' % old
+    db.execute('CREATE TEMP TABLE %s AS %s ORDER BY name, type, path' %
+               (table, query))
+    return db.execute('SELECT count(*) FROM temp.%s' % table).fetchone()[0]
+
+
+def has_digests(db, schema):
+    """Whether the attached db records the digest of each entry's section."""
+    return db.execute(
+        "SELECT count(*) FROM %s.sqlite_master WHERE name = 'entryDigest'" %
+        schema).fetchone()[0] > 0
+
+
+def store_modified(db, old, new):
+    """
+    Store the entries of both attached dbs whose section digest differs
+    into the temp table `modified`. The digests recorded by the builder are
+    compared, so no page is parsed again.
+    """
+    db.execute('DROP TABLE IF EXISTS temp.digests')
+    db.execute('DROP TABLE IF EXISTS temp.modified')
+    # digests which aren't in old, merging the two tables along their key
+    db.execute(
+        'CREATE TEMP TABLE digests AS '
+        'SELECT type, path, digest FROM {1}.entryDigest EXCEPT '
+        'SELECT type, path, digest FROM {0}.entryDigest '
+        'ORDER BY type, path, digest'.format(old, new))
+    # the entries of those which are in both dbs, in one scan of the new
+    # index, which has no index on path; CROSS JOIN keeps that order
+    db.execute(
+        'CREATE TEMP TABLE modified AS '
+        'SELECT n.name, n.type, n.path FROM {1}.searchIndex n '
+        'CROSS JOIN temp.digests d ON d.type = n.type AND d.path = n.path '
+        'CROSS JOIN {0}.entryDigest od '
+        'ON od.type = n.type AND od.path = n.path '
+        'CROSS JOIN {0}.searchIndex o '
+        'ON o.name = n.name AND o.type = n.type AND o.path = n.path'.format(
+            old, new))
+    return db.execute('SELECT count(*) FROM temp.modified').fetchone()[0]
+
+
+def iter_docs(db, table):
+    """Yield (doc, entries) of the changes, without fetching them all."""
+    rows = db.execute(
+        'SELECT {0} AS doc, name, type, path FROM temp.{1} '
+        'ORDER BY doc, path, name, type'.format(DOC, table))
+    for doc, group in groupby(rows, key=lambda row: row[0]):
+        yield doc, [row[1:] for row in group]
+
+
+def print_entries(doc, entries):
+    print("%s: %d" % (doc, len(entries)))
+    max_len = [0, 0, 0]
+    for entry in entries:
+        for j, e in enumerate(entry):
+            max_len[j] = max(max_len[j], len(e))
+    format_str = '\t' + '\t'.join(('%%-%ds' % length) for length in max_len)
+    for entry in entries:
+        print(format_str % entry)
+    print('')
+
+
+def diff(db, old, new, old_name, new_name, as_json=False):
+    """
+    Print the entries added and removed between the attached dbs `old` and
+    `new`, and the ones whose documentation changed if both dbs have their
+    digests, doc by doc. With `as_json`, print a JSON object for each doc
+    instead.
+    """
+    if not as_json:
+        print('%s -> %s' % (old_name or '(empty)', new_name))
+    changes = (
+        ('added', old, new),
+        ('removed', new, old),
+        ('modified', old, new),
+    )
+    for change, old_db, new_db in changes:
+        if new_db is None:
+            # nothing is removed from an empty db
+            total = 0
+        elif change == 'modified':
+            if old_db is None or not (has_digests(db, old_db)
+                                      and has_digests(db, new_db)):
                 continue
-            entries_in_previous_doc = entries[start:i]
-            start = i
+            total = store_modified(db, old_db, new_db)
         else:
-            entries_in_previous_doc = entries[start:]
-        print("%s: %d" % (os.path.splitext(current_doc)[0],
-                          len(entries_in_previous_doc)))
-        max_len = [0, 0, 0]
-        for entry in entries_in_previous_doc:
-            for j, e in enumerate(entry):
-                max_len[j] = max(max_len[j], len(e))
-        format_str = '\t' + '\t'.join(('%%-%ds' % length)
-                                      for length in max_len)
-        for entry in entries_in_previous_doc:
-            print(format_str % entry)
-        print('')
-        current_doc = doc_name
+            total = store_changes(db, change, old_db, new_db)
+        if not as_json:
+            print("%s: %d" % (change.capitalize(), total))
+        if not total:
+            continue
+        for doc, entries in iter_docs(db, change):
+            if as_json:
+                print(json.dumps({
+                    'old': old_name,
+                    'new': new_name,
+                    'change': change,
+                    'doc': doc,
+                    'entries': entries,
+                }))
+            else:
+                print_entries(doc, entries)
+
+
+def diff_chain(db_names, as_json=False):
+    """
+    Diff each db with the next one. Only the two dbs being compared are
+    attached at a time, as sqlite limits how many can be.
+    """
+    db = sqlite3.connect(':memory:')
+    if len(db_names) == 1:
+        db_names = [None] + db_names
+    for i, (old_name, new_name) in enumerate(zip(db_names, db_names[1:])):
+        old = 'v%d' % i if old_name is not None else None
+        new = 'v%d' % (i + 1)
+        if i == 0 and old is not None:
+            db.execute('ATTACH DATABASE ? AS %s' % old, (old_name, ))
+        db.execute('ATTACH DATABASE ? AS %s' % new, (new_name, ))
+        diff(db, old, new, old_name, new_name, as_json)
+        if old is not None:
+            db.execute('DETACH DATABASE %s' % old)
+    db.close()
 
 
 if __name__ == '__main__':
-    argc = len(sys.argv)
-    if (argc == 2 or argc == 3) and sys.argv[1] not in ('-h', '--help'):
-        if argc == 3:
-            old = get_entries(sys.argv[1])
-            new = get_entries(sys.argv[2])
-            diff(old, new)
-        else:
-            entries = get_entries(sys.argv[1])
-            diff(set(), entries)
-    else:
-        print("Diff entries with given sqlite3 db")
-        print("Usage: %s [old_sqlite.db] new_sqlite.db")
+    parser = argparse.ArgumentParser(
+        description='Diff entries with given sqlite3 db. With one db, all its '
+        'entries are added; with more, each db is diffed with the next one.')
+    parser.add_argument(
+        'dbs', nargs='+', metavar='db', help='searchIndex db, oldest first')
+    parser.add_argument(
+        '--json',
+        action='store_true',
+        help='print a JSON object for each changed doc, one per line')
+    args = parser.parse_args()
+    diff_chain(args.dbs, args.json)
@@ -5,22 +5,43 @@ Build dash docset for OpenResty.
 See https://kapeli.com/docsets for how to build docset.
 """
 from __future__ import print_function, unicode_literals
-from collections import namedtuple
+from collections import deque, namedtuple
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from email.utils import parsedate_tz, mktime_tz
 from sys import stdout
-from threading import Thread, Lock
+from threading import Lock, Thread
+import argparse
+import asyncio
 import codecs
+import copy
+import cProfile
+import ctypes
+import errno
+import hashlib
+import json
 import logging
 import os
+import pstats
+import queue
+import random
+import re
 import shutil
 import signal
 import sqlite3
 import sys
+import tempfile
+import time
+import tracemalloc
 import traceback
 
 # pip install -r requirements.txt
 try:
-    from bs4 import BeautifulSoup
-    from requests.exceptions import HTTPError
+    from bs4 import BeautifulSoup, Comment, Doctype, Tag
+    from requests.adapters import HTTPAdapter
+    from requests.compat import urlparse
+    from requests.exceptions import (ConnectionError, HTTPError,
+                                     RequestException, Timeout)
     from requests.utils import quote
     import requests
 except ImportError:
@@ -29,7 +50,9 @@ except ImportError:
     sys.exit(1)
 
 Resource = namedtuple('Resource', ['filename', 'url'])
-Entry = namedtuple('Entry', ['name', 'type', 'path'])
+# digest is the section_digest of the entry's section, None if unknown
+Entry = namedtuple(
+    'Entry', ['name', 'type', 'path', 'digest'], defaults=[None])
 
 
 class Doc(object):
@@ -37,6 +60,11 @@ class Doc(object):
         self.name = name
         self.url = url
         self.sections = sections
+        match = REPO_URL.match(url)
+        if match is not None:
+            self.repo, self.ref, self.readme = match.groups()
+        else:
+            self.repo = self.ref = self.readme = None
         doc = url.rsplit('/', 1)[-1]
         name = os.path.splitext(doc)[0]
         name = name.lower()
@@ -45,9 +73,46 @@ class Doc(object):
         else:
             self.module = None
 
+    def copy(self):
+        return Doc(self.name, self.url, self.sections)
+
+    def at(self, ref):
+        """Return a copy of the doc at the tag or commit ref of its repo."""
+        return Doc(self.name,
+                   build_url_from_repo_name(self.repo, self.readme, ref),
+                   self.sections)
+
+    def reassign_name(self):
+        """
+        Give each doc of a repo which has several docs its own name, and so
+        its own page.
+        """
+        if self.module is not None and not self.name.endswith(
+                '-' + self.module):
+            self.name += '-' + self.module
+
+
+DEFAULT_REF = 'master'
+# repo, ref and readme of a doc's url
+REPO_URL = re.compile(
+    r'^https://github\.com/openresty/([^/]+)/blob/([^/]+)/(.+)$')
+
+
+def build_url_from_repo_name(repo, readme='README.markdown', ref=DEFAULT_REF):
+    return 'https://github.com/openresty/%s/blob/%s/%s' % (repo, ref, readme)
+
 
-def build_url_from_repo_name(repo, readme='README.markdown'):
-    return 'https://github.com/openresty/%s/blob/master/%s' % (repo, readme)
+# where the head commit of a ref is polled, see watch.py
+HEAD_URL = 'https://api.github.com/repos/openresty/{repo}/commits/{ref}'
+
+
+def is_pinned(url):
+    """
+    Whether url is a page at a tag or commit, which never changes. Only the
+    default branch moves: the refs of releases are tags or commits.
+    """
+    match = REPO_URL.match(url)
+    return match is not None and match.group(2) != DEFAULT_REF
 
 
 # List all docs of projects distributed with OpenResty tar package.
@@ -186,22 +251,804 @@ DOCS = [
 DOC_NAMES = set(doc.name for doc in DOCS)
 
 
-def _get_from_url(url, attr):
-    retry = 0
-    while retry < 3:
-        res = requests.get(url)
-        if res.status_code in (200, 304):
-            return getattr(res, attr)
-        retry += 1
-    raise HTTPError(res)
+def load_releases(fn):
+    """
+    Load {release: {repo: tag or commit}} from the JSON file fn, which maps
+    each OpenResty release to the version of each component bundled in it.
+    """
+    with open(fn) as f:
+        releases = json.load(f)
+    repos = set(doc.repo for doc in DOCS)
+    for release, refs in releases.items():
+        unknown = set(refs) - repos
+        if unknown:
+            raise ValueError('release %s: no doc for %s' %
+                             (release, ', '.join(sorted(unknown))))
+    return releases
+
+
+def release_docs(refs, docs=DOCS):
+    """
+    Return the docs of a release, each at the ref of its repo in refs. The
+    docs of repos which aren't in refs are left out, as the release doesn't
+    bundle them.
+    """
+    return [doc.at(refs[doc.repo]) for doc in docs if doc.repo in refs]
+
+
+# Rough page sizes in KB of the biggest docs, used to schedule them first
+# when there is no report of a previous build.
+SIZE_HINTS = {
+    'lua-nginx-module': 1600,
+    'stream-lua-nginx-module': 500,
+    'echo-nginx-module': 250,
+    'lua-resty-core': 200,
+    'ngx_postgres': 150,
+    'srcache-nginx-module': 150,
+    'set-misc-nginx-module': 150,
+    'headers-more-nginx-module': 120,
+    'memc-nginx-module': 120,
+    'lua-resty-redis': 120,
+    'lua-resty-mysql': 100,
+    'lua-resty-core-ssl': 100,
+}
+DEFAULT_SIZE_HINT = 60
+
+
+class ResponseCache(object):
+    """
+    On-disk cache of HTTP response bodies.
+    Each body is stored in its own file, while its ETag/Last-Modified and
+    last access time are kept in an index. Cached urls are revalidated with
+    conditional GET, and the least recently used bodies are evicted once the
+    total size exceeds max_size.
+    The index is only kept in memory until save() is called at the end of
+    the build. Bodies left out of the index by a build which didn't get
+    there are removed on the next run.
+    """
+    index_name = 'index.json'
+
+    def __init__(self, path, max_size):
+        self.path = path
+        self.max_size = max_size
+        self.lock = Lock()
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self.index = {}
+        index_path = os.path.join(path, self.index_name)
+        if os.path.isfile(index_path):
+            try:
+                with open(index_path) as f:
+                    self.index = json.load(f)
+            except ValueError:
+                # a broken index only costs us a full download
+                self.index = {}
+        used = set(self._key(url) for url in self.index)
+        now = time.time()
+        for fn in os.listdir(path):
+            if fn == self.index_name or fn in used:
+                continue
+            fn = os.path.join(path, fn)
+            # leave the bodies being written by another build
+            if os.path.getmtime(fn) < now - 3600:
+                os.remove(fn)
+
+    @staticmethod
+    def _key(url):
+        return hashlib.sha1(url.encode('utf-8')).hexdigest()
+
+    def _body_path(self, url):
+        return os.path.join(self.path, self._key(url))
+
+    def validators(self, url):
+        """Return the headers used to revalidate the cached body of url."""
+        headers = {}
+        with self.lock:
+            meta = self.index.get(url)
+            if meta is None or not os.path.isfile(self._body_path(url)):
+                return headers
+            if meta.get('etag'):
+                headers['If-None-Match'] = meta['etag']
+            if meta.get('last_modified'):
+                headers['If-Modified-Since'] = meta['last_modified']
+        return headers
+
+    def get(self, url):
+        """Return (content, encoding) of the cached body, or None."""
+        with self.lock:
+            meta = self.index.get(url)
+            if meta is None:
+                return None
+            try:
+                with open(self._body_path(url), 'rb') as f:
+                    content = f.read()
+            except IOError:
+                del self.index[url]
+                return None
+            meta['atime'] = time.time()
+            return content, meta.get('encoding')
+
+    def copy_to(self, url, fn):
+        """Copy the cached body into fn, return False if not cached."""
+        with self.lock:
+            meta = self.index.get(url)
+            if meta is None:
+                return False
+            try:
+                shutil.copyfile(self._body_path(url), fn)
+            except IOError:
+                del self.index[url]
+                return False
+            meta['atime'] = time.time()
+            return True
+
+    def put(self, url, res):
+        self._put(url, res, lambda f: f.write(res.content))
+
+    def put_file(self, url, res, fn):
+        """Cache the body of res, which has been saved into fn."""
+
+        def copy(f):
+            with open(fn, 'rb') as body:
+                shutil.copyfileobj(body, f)
+
+        self._put(url, res, copy)
+
+    def _put(self, url, res, write_body):
+        etag = res.headers.get('ETag')
+        last_modified = res.headers.get('Last-Modified')
+        if not etag and not last_modified:
+            # nothing to revalidate with
+            return
+        # the body is written without holding the lock, then renamed in place
+        with tempfile.NamedTemporaryFile(
+                dir=self.path, suffix='.part', delete=False) as f:
+            write_body(f)
+        with self.lock:
+            body_path = self._body_path(url)
+            os.rename(f.name, body_path)
+            self.index[url] = {
+                'etag': etag,
+                'last_modified': last_modified,
+                'encoding': res.encoding,
+                'size': os.path.getsize(body_path),
+                'atime': time.time(),
+            }
+            self._evict()
+
+    def _evict(self):
+        total = sum(meta['size'] for meta in self.index.values())
+        if total <= self.max_size:
+            return
+        lru = sorted(self.index.items(), key=lambda item: item[1]['atime'])
+        for url, meta in lru:
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(self._body_path(url))
+            except OSError:
+                pass
+            del self.index[url]
+            total -= meta['size']
+
+    def save(self):
+        """Write the index, with the access times of this run."""
+        with self.lock:
+            content = json.dumps(self.index)
+        index_path = os.path.join(self.path, self.index_name)
+        with open(index_path + '.tmp', 'w') as f:
+            f.write(content)
+        os.rename(index_path + '.tmp', index_path)
+
+
+# How many docs and resources are fetched at the same time
+CONCURRENCY = 5
+
+
+def fetch_threads(concurrency=CONCURRENCY):
+    """
+    Threads of SessionTransport, which fetches up to `concurrency` docs and
+    as many resources at the same time.
+    """
+    return concurrency * 2
+
+
+def create_session(pool_size=fetch_threads()):
+    """
+    Create a session shared by all threads, so connections to the same host
+    are kept alive and reused instead of paying a new TCP/TLS handshake for
+    each request. pool_size should be the number of threads sending
+    requests, or urllib3 discards the extra connections.
+    """
+    session = requests.Session()
+    # pool_connections is the number of hosts whose pools are kept around,
+    # pool_maxsize the number of connections kept alive per host
+    adapter = HTTPAdapter(pool_connections=16, pool_maxsize=pool_size)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    encodings = ['gzip', 'deflate']
+    try:
+        # urllib3 decodes br only when a brotli binding is installed
+        import brotli  # noqa: F401
+        encodings.append('br')
+    except ImportError:
+        pass
+    session.headers['Accept-Encoding'] = ', '.join(encodings)
+    return session
+
+
+def connection_stats(session):
+    """
+    Return {host: (requests, connections)} of the session's connection
+    pools. The difference is the number of requests sent over a reused
+    connection.
+    """
+    stats = {}
+    adapter = session.get_adapter('https://')
+    pools = adapter.poolmanager.pools
+    for key in pools.keys():
+        pool = pools.get(key)
+        if pool is None:
+            continue
+        requests_num, connections = stats.get(pool.host, (0, 0))
+        stats[pool.host] = (requests_num + pool.num_requests,
+                            connections + pool.num_connections)
+    return stats
+
+
+class ProfileResult(object):
+    """cProfile stats sent back by a parse process, loadable by pstats."""
+
+    def __init__(self, stats):
+        self.stats = stats
+
+    def create_stats(self):
+        pass
+
+
+class BuildStats(object):
+    """
+    Timing spans of each stage of the build, with the numbers of each doc
+    and resource, reported as JSON at the end of the build.
+    With `profile`, each span which doesn't await is also run under
+    cProfile, or has its allocations traced by tracemalloc.
+    """
+
+    def __init__(self, profile=None):
+        self.lock = Lock()
+        self.start = time.time()
+        self.profile = profile
+        # stage => {'count': ..., 'seconds': ...}
+        self.stages = {}
+        # doc name or resource url => {counter: value}
+        self.docs = {}
+        self.resources = {}
+        # url => retry times
+        self.retries = {}
+        # 'html' or 'css' => {'before': bytes, 'after': bytes} of compacting
+        self.sizes = {}
+        # stage => pstats.Stats, or allocated bytes with tracemalloc
+        self.profiles = {}
+        if profile == 'tracemalloc':
+            tracemalloc.start()
+
+    def add(self, items, key, **values):
+        """Add values to the counters of items[key]."""
+        with self.lock:
+            counters = items.setdefault(key, {})
+            for name, value in values.items():
+                counters[name] = counters.get(name, 0) + value
+
+    def set(self, items, key, **values):
+        with self.lock:
+            items.setdefault(key, {}).update(values)
+
+    def retry(self, url):
+        with self.lock:
+            self.retries[url] = self.retries.get(url, 0) + 1
+
+    def add_profile(self, stage, result):
+        with self.lock:
+            if stage in self.profiles:
+                self.profiles[stage].add(result)
+            else:
+                self.profiles[stage] = pstats.Stats(result)
+
+    @contextmanager
+    def span(self, stage, items=None, key=None, profile=True):
+        """Time the block as `stage`, and as a counter of items[key]."""
+        profiler = None
+        allocated = 0
+        if profile and self.profile == 'cprofile':
+            profiler = cProfile.Profile()
+            try:
+                profiler.enable()
+            except ValueError:
+                # another profiler is active, which is forbidden since 3.12
+                profiler = None
+        elif profile and self.profile == 'tracemalloc':
+            allocated = tracemalloc.get_traced_memory()[0]
+        start = time.time()
+        try:
+            yield
+        finally:
+            seconds = time.time() - start
+            if profiler is not None:
+                profiler.disable()
+                self.add_profile(stage, profiler)
+            elif profile and self.profile == 'tracemalloc':
+                allocated = tracemalloc.get_traced_memory()[0] - allocated
+                with self.lock:
+                    self.profiles[stage] = self.profiles.get(stage,
+                                                             0) + allocated
+            with self.lock:
+                total = self.stages.setdefault(stage, {
+                    'count': 0,
+                    'seconds': 0.0
+                })
+                total['count'] += 1
+                total['seconds'] += seconds
+            if items is not None:
+                self.add(items, key, **{stage: seconds})
+
+    def report(self, connections=None):
+        with self.lock:
+            docs = dict((name, dict(counters))
+                        for name, counters in self.docs.items())
+            resources = dict((url, dict(counters))
+                             for url, counters in self.resources.items())
+            for items in (docs, resources):
+                for key, counters in items.items():
+                    url = counters.get('url', key)
+                    counters['retries'] = self.retries.get(url, 0)
+            report = {
+                'started': self.start,
+                'seconds': time.time() - self.start,
+                'stages': self.stages,
+                'docs': docs,
+                'resources': resources,
+                'sizes': dict((kind, dict(sizes))
+                              for kind, sizes in self.sizes.items()),
+            }
+            if connections is not None:
+                report['connections'] = dict(
+                    (host, {
+                        'requests': requests_num,
+                        'connections': connections_num
+                    })
+                    for host, (requests_num,
+                               connections_num) in connections.items())
+            if self.profile == 'cprofile':
+                report['profile'] = {}
+                for stage, stats in self.profiles.items():
+                    stats.sort_stats('cumulative')
+                    report['profile'][stage] = [
+                        '%s:%d(%s) %.3fs' %
+                        (func[0], func[1], func[2], stats.stats[func][3])
+                        for func in stats.fcn_list[:20]
+                    ]
+            elif self.profile == 'tracemalloc':
+                current, peak = tracemalloc.get_traced_memory()
+                snapshot = tracemalloc.take_snapshot()
+                report['profile'] = {
+                    'allocated': self.profiles,
+                    'current': current,
+                    'peak': peak,
+                    'top': [
+                        str(stat)
+                        for stat in snapshot.statistics('lineno')[:20]
+                    ],
+                }
+        return report
+
+    def dump_profiles(self, prefix):
+        """Save the cProfile stats of each stage as prefix.stage.pstats."""
+        if self.profile != 'cprofile':
+            return
+        with self.lock:
+            for stage, stats in self.profiles.items():
+                stats.dump_stats('%s.%s.pstats' % (prefix, stage))
+
+
+def upstream_url(url, upstream=None):
+    """
+    Redirect url to upstream/host/path if an upstream is given, to build
+    against a local stand-in of GitHub like `bench.py serve`.
+    """
+    if upstream is None:
+        return url
+    return upstream.rstrip('/') + '/' + url.split('://', 1)[-1]
+
+
+def _decode(content, encoding):
+    return content.decode(encoding or 'utf-8', 'replace')
+
+
+class RateLimiter(object):
+    """
+    Token bucket shared by all fetchers: `rate` requests per second on
+    average, with bursts of up to `burst` requests. All fetchers are also
+    paused when GitHub says the rate limit is exhausted or asks us to retry
+    after some time.
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated_at = time.time()
+        self.paused_until = 0
+        self.lock = Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.time()
+                self.tokens = min(
+                    self.burst,
+                    self.tokens + (now - self.updated_at) * self.rate)
+                self.updated_at = now
+                if now >= self.paused_until and self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = max(self.paused_until - now,
+                           (1 - self.tokens) / self.rate)
+            time.sleep(wait)
+
+    def pause(self, seconds):
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.time() + seconds)
+
+    def update(self, res):
+        """
+        Pause until the rate limit is reset if res says it is exhausted.
+        Return the pause in seconds, or None.
+        """
+        retry_after = res.headers.get('Retry-After')
+        if retry_after is not None:
+            if retry_after.isdigit():
+                seconds = int(retry_after)
+            else:
+                date = parsedate_tz(retry_after)
+                seconds = mktime_tz(date) - time.time() if date else 0
+            seconds = max(0, seconds)
+            self.pause(seconds)
+            return seconds
+        if res.headers.get('X-RateLimit-Remaining') == '0':
+            reset = res.headers.get('X-RateLimit-Reset', '')
+            if reset.isdigit():
+                seconds = max(0, int(reset) - time.time())
+                self.pause(seconds)
+                return seconds
+        return None
+
+
+class CircuitOpenError(RequestException):
+    pass
+
+
+class CircuitBreaker(object):
+    """
+    Stop sending requests to a host after `threshold` failures in a row,
+    so a failing host doesn't burn the retries. After `cooldown` seconds,
+    a single request is let through to probe the host again.
+    """
+
+    def __init__(self, threshold=5, cooldown=60):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        # host => [failures in a row, time the circuit opened]
+        self.hosts = {}
+        self.lock = Lock()
+
+    def check(self, host):
+        with self.lock:
+            failures, opened_at = self.hosts.get(host, (0, None))
+            if opened_at is None:
+                return
+            if time.time() - opened_at < self.cooldown:
+                raise CircuitOpenError(
+                    'too many failures of %s, stop requesting it' % host)
+            # let one request probe the host, until it fails again
+            self.hosts[host] = [failures, time.time()]
+
+    def succeed(self, host):
+        with self.lock:
+            self.hosts.pop(host, None)
+
+    def fail(self, host):
+        with self.lock:
+            state = self.hosts.setdefault(host, [0, None])
+            state[0] += 1
+            if state[0] >= self.threshold:
+                state[1] = time.time()
+
+
+RATE = 10
+RETRIES = 5
+REQUEST_TIMEOUT = 60
+
+
+def backoff(retry, base=0.5, cap=60):
+    """Exponential backoff with full jitter."""
+    return random.uniform(0, min(cap, base * 2**retry))
+
+
+CHUNK_SIZE = 64 * 1024
+
+
+class Fetcher(object):
+    """
+    Fetch urls with `session`, from `upstream`/host/path if given, and
+    revalidate the bodies kept by `cache`, a ResponseCache, if there is
+    one. All requests wait for `rate_limiter` and go through
+    `circuit_breaker`; failed ones are retried up to `retries` times and
+    counted in `stats`.
+    """
+
+    def __init__(self,
+                 session=None,
+                 cache=None,
+                 upstream=None,
+                 rate_limiter=None,
+                 circuit_breaker=None,
+                 retries=RETRIES,
+                 stats=None):
+        self.session = session or create_session()
+        self.cache = cache
+        self.upstream = upstream
+        self.rate_limiter = rate_limiter or RateLimiter(
+            RATE, fetch_threads())
+        self.circuit_breaker = circuit_breaker or CircuitBreaker()
+        self.retries = retries
+        self.stats = stats or BuildStats()
+
+    def with_stats(self, stats):
+        """Return a fetcher sharing everything with this one but stats."""
+        fetcher = copy.copy(self)
+        fetcher.stats = stats
+        return fetcher
+
+    def fetch(self, url, use_cached, stream=False, cache=None, headers=None):
+        """
+        GET url with `headers`, revalidating the body cached by `cache`,
+        the fetcher's one by default, if there is one.
+        Return (response, None), or (None, use_cached()) if the cached body
+        is still valid.
+        Failed requests are retried with backoff, throttled ones after the
+        time GitHub asks for.
+        """
+        cache = cache or self.cache
+        validators = cache.validators(url) if cache is not None else {}
+        host = urlparse(url).netloc
+        retry = 0
+        while True:
+            self.circuit_breaker.check(host)
+            self.rate_limiter.acquire()
+            try:
+                res = self.session.get(
+                    upstream_url(url, self.upstream),
+                    headers=dict(headers or {}, **validators),
+                    stream=stream,
+                    timeout=REQUEST_TIMEOUT)
+            except (ConnectionError, Timeout):
+                self.circuit_breaker.fail(host)
+                if retry >= self.retries:
+                    raise
+                self.stats.retry(url)
+                time.sleep(backoff(retry))
+                retry += 1
+                continue
+            pause = self.rate_limiter.update(res)
+            if res.status_code == 304 and validators:
+                self.circuit_breaker.succeed(host)
+                res.close()
+                result = use_cached()
+                if result is not None:
+                    return None, result
+                # evicted between revalidation and read, fetch it again
+                validators = {}
+                continue
+            if res.status_code in (200, 304):
+                self.circuit_breaker.succeed(host)
+                return res, None
+            res.close()
+            throttled = res.status_code == 429 or (res.status_code == 403
+                                                   and pause is not None)
+            if not throttled and res.status_code < 500:
+                # retrying won't help
+                raise HTTPError(
+                    '%d %s' % (res.status_code, url), response=res)
+            if not throttled:
+                self.circuit_breaker.fail(host)
+            if retry >= self.retries:
+                raise HTTPError(
+                    '%d %s' % (res.status_code, url), response=res)
+            self.stats.retry(url)
+            if pause is None:
+                # the limiter waits for the pause before the next request
+                time.sleep(backoff(retry))
+            retry += 1
+
+    def _get(self, url, attr, headers=None):
+        cache = self.cache
+
+        def use_cached():
+            cached = cache.get(url)
+            if cached is None:
+                return None
+            content, encoding = cached
+            if attr == 'text':
+                return _decode(content, encoding)
+            return content
+
+        if cache is not None and is_pinned(url):
+            # no need to revalidate what can't change
+            result = use_cached()
+            if result is not None:
+                return result
+        res, result = self.fetch(url, use_cached, headers=headers)
+        if res is None:
+            return result
+        if cache is not None and res.status_code == 200:
+            cache.put(url, res)
+        return getattr(res, attr)
+
+    def get_text(self, url, headers=None):
+        return self._get(url, 'text', headers)
+
+    def get_binary(self, url):
+        return self._get(url, 'content')
+
+    def download_to_file(self, url, fn):
+        """Stream the body of url into fn, without holding it in memory."""
+        res, _ = self.fetch(
+            url, lambda: self.cache.copy_to(url, fn) or None, True)
+        if res is None:
+            return
+        with res:
+            with open(fn + '.part', 'wb') as f:
+                for chunk in res.iter_content(CHUNK_SIZE):
+                    f.write(chunk)
+        os.rename(fn + '.part', fn)
+        if self.cache is not None and res.status_code == 200:
+            self.cache.put_file(url, res, fn)
+
+
+class ResourceStore(object):
+    """
+    Content-addressed store of resources shared by all builds. Each body is
+    stored once under its digest, however many urls it is downloaded from,
+    and linked into the docset, so identical files take the space of one.
+    The digest, ETag and Last-Modified of each url are kept in an index, so
+    an unchanged resource is revalidated without downloading or writing it
+    again. Urls not used for max_age seconds are forgotten, and the bodies
+    no url refers to are removed. Last use times are kept in the index, as
+    the bodies share their mtime with the docset's files.
+    A url is only revalidated once per run, however many docsets use it.
+    """
+    index_name = 'index.json'
+
+    def __init__(self, path, max_age=30 * 24 * 3600):
+        self.path = path
+        self.lock = Lock()
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self.urls = {}
+        index_path = os.path.join(path, self.index_name)
+        if os.path.isfile(index_path):
+            try:
+                with open(index_path) as f:
+                    self.urls = json.load(f)
+            except ValueError:
+                self.urls = {}
+        # urls revalidated or downloaded by this run
+        self.checked = set()
+        now = time.time()
+        self.urls = dict((url, meta) for url, meta in self.urls.items()
+                         if meta.get('atime', 0) >= now - max_age)
+        used = set(meta['digest'] for meta in self.urls.values())
+        for fn in os.listdir(path):
+            if fn == self.index_name or fn in used:
+                continue
+            fn = os.path.join(path, fn)
+            # leave the bodies being downloaded by another build
+            if os.path.getmtime(fn) < now - 3600:
+                os.remove(fn)
+
+    def _object_path(self, digest):
+        return os.path.join(self.path, digest)
+
+    def validators(self, url):
+        headers = {}
+        with self.lock:
+            meta = self.urls.get(url)
+            if meta is None or not os.path.isfile(
+                    self._object_path(meta['digest'])):
+                return headers
+            if meta.get('etag'):
+                headers['If-None-Match'] = meta['etag']
+            if meta.get('last_modified'):
+                headers['If-Modified-Since'] = meta['last_modified']
+        return headers
+
+    def link(self, digest, fn):
+        """
+        Link the body into fn, unless fn is it already. Return False if the
+        body has been removed.
+        """
+        body = self._object_path(digest)
+        try:
+            if os.path.samefile(body, fn):
+                return True
+        except OSError:
+            pass
+        try:
+            os.link(body, fn + '.part')
+        except FileExistsError:
+            os.remove(fn + '.part')
+            return self.link(digest, fn)
+        except FileNotFoundError:
+            return False
+        except OSError:
+            # no hard links across file systems
+            shutil.copyfile(body, fn + '.part')
+        os.rename(fn + '.part', fn)
+        return True
 
+    def download(self, url, fn, fetcher):
+        """
+        Save the body of url as fn, downloading it with fetcher only if it
+        changed.
+        """
 
-def get_text_from_url(url):
-    return _get_from_url(url, 'text')
+        def use_cached():
+            with self.lock:
+                meta = self.urls[url]
+                meta['atime'] = time.time()
+            return self.link(meta['digest'], fn) or None
 
+        with self.lock:
+            checked = url in self.checked
+        if checked and use_cached():
+            return
+        res, _ = fetcher.fetch(url, use_cached, True, self)
+        if res is None:
+            with self.lock:
+                self.checked.add(url)
+            return
+        h = hashlib.sha1()
+        with res:
+            with tempfile.NamedTemporaryFile(
+                    dir=self.path, suffix='.part', delete=False) as f:
+                for chunk in res.iter_content(CHUNK_SIZE):
+                    h.update(chunk)
+                    f.write(chunk)
+        digest = h.hexdigest()
+        body = self._object_path(digest)
+        with self.lock:
+            if os.path.isfile(body):
+                # the same body downloaded from another url
+                os.remove(f.name)
+            else:
+                os.rename(f.name, body)
+            self.urls[url] = {
+                'digest': digest,
+                'etag': res.headers.get('ETag'),
+                'last_modified': res.headers.get('Last-Modified'),
+                'atime': time.time(),
+            }
+            self.checked.add(url)
+        self.link(digest, fn)
 
-def get_binary_from_url(url):
-    return _get_from_url(url, 'content')
+    def save(self):
+        """Write the index, with the access times of this run."""
+        with self.lock:
+            content = json.dumps(self.urls)
+        index_path = os.path.join(self.path, self.index_name)
+        with open(index_path + '.tmp', 'w') as f:
+            f.write(content)
+        os.rename(index_path + '.tmp', index_path)
 
 
 TYPE_MAP = {
@@ -218,114 +1065,99 @@ def get_type(section):
     return TYPE_MAP.get(section, 'Function')
 
 
-def parse_doc_from_html(html, metadata):
+# Backends accepted by parse_doc_from_html: the first ones are the tree
+# builders of BeautifulSoup, 'lxml.html' works on lxml's own tree.
+PARSERS = ('html.parser', 'lxml', 'lxml.html')
+
+
+def rewrite_doc_link(href):
     """
-    Parse the document part of html page according to the metadata.
-    Return:
-    1. a list of Entries
-    2. a set of Resources
-    3. a html snippet with anchor added, resource urls rewritten,
-       useless parts removed
+    Rewrite links to the other docs in the docset to the local pages.
+    Return None if href should be kept.
     """
-    soup = BeautifulSoup(html, 'html.parser')
+    if not href.startswith(('https://github.com/openresty/',
+                            'http://github.com/openresty')):
+        return None
+    href = href.rpartition('/')[-1]
+    href, _, anchor = href.partition('#')
+    if href not in DOC_NAMES:
+        return None
+    href += '.html'
+    if anchor != 'readme':
+        href += '#' + anchor
+    return href
 
-    resources = set()
-    rewritten_head = '<title>%s</title>\n' % metadata.name
-    for css in soup.findAll('link', rel='stylesheet'):
-        link = css['href'].rpartition('/')[-1]
-        resources.add(Resource(filename=link, url=css['href']))
-        new_css = soup.new_tag('link')
-        new_css['rel'] = 'stylesheet'
-        new_css['href'] = link
-        rewritten_head += str(new_css)
-    for img in soup.select('#readme img'):
-        src = metadata.name + '-' + img['src'].rpartition('/')[-1]
-        resources.add(Resource(filename=src, url=img['src']))
-        img['src'] = src
-    for link in soup.select('#readme a'):
-        if link['href'].startswith(
-                ('https://github.com/openresty/',
-                 'http://github.com/openresty')):
-            href = link['href'].rpartition('/')[-1]
-            href, _, anchor = href.partition('#')
-            if href not in DOC_NAMES:
-                continue
-            href += '.html'
-            if anchor != 'readme':
-                href += '#' + anchor
-            link['href'] = href
 
-    entries = []
-    readme = soup.find(id='readme')
-    base_path = '%s.html' % metadata.name
+def resource_filename(url):
+    """
+    Name of the file url is saved as, which is unique to url, so files
+    with the same basename don't overwrite each other, and a url used by
+    several docs is saved once.
+    """
+    basename = urlparse(url).path.rpartition('/')[-1] or 'index'
+    return '%s-%s' % (hashlib.sha1(url.encode('utf-8')).hexdigest()[:10],
+                      basename)
 
-    def handle_each_section(section_header,
-                            section_type,
-                            entry_header,
-                            module=None):
-        for tag in section_header.next_siblings:
-            # not all siblings are tags
-            if not hasattr(tag, 'name'):
-                continue
-            if tag.name == section_header.name:
-                break
-            if tag.name == entry_header:
-                api_name = next(tag.stripped_strings)
-                tag_anchor = next(tag.children)
-                entry_path = base_path + tag_anchor['href']
-                if section_type == 'Method':
-                    api_name = module + ':' + api_name
-                entries.append(
-                    Entry(
-                        name=api_name, type=section_type, path=entry_path))
-                # insert an anchor to support table of contents
-                anchor = soup.new_tag('a')
-                anchor['name'] = '//apple_ref/cpp/%s/%s' % (section_type,
-                                                            quote(api_name))
-                anchor['class'] = 'dashAnchor'
-                tag_anchor.insert_before(anchor)
 
+def iter_sections(metadata):
+    """
+    Yield (section id, entry type, entry header, module, class entry) of
+    each section of the doc. The entry header is None if it is one level
+    lower than the section's header.
+    """
+    base_path = '%s.html' % metadata.name
     if metadata.name == 'lua-resty-websocket':
         for section in metadata.sections:
             section_path = section.replace('.', '')
-            entries.append(
-                Entry(
-                    name=section,
-                    type='Class',
-                    path=base_path + '#' + section_path))
-            section_header = soup.find(
-                id=('user-content-' + section_path)).parent
             module = section.rsplit('.', 1)[-1]
             if module == 'client':
                 module = 'websocket'
             else:
                 module = 'websocket' + ':' + module
-            handle_each_section(section_header, 'Method', 'h4', module)
+            yield (section_path, 'Method', 'h4', module,
+                   Entry(
+                       name=section,
+                       type='Class',
+                       path=base_path + '#' + section_path))
     # TODO need special hack for stream-lua-nginx-module, or should I change
     # the doc style of this project?
     else:
         for section in metadata.sections:
-            section_type = get_type(section)
-            section_header = soup.find(id=('user-content-' + section)).parent
-            # all entries' header is one level lower than section's header
-            entry_header = 'h' + str(int(section_header.name[1]) + 1)
             if metadata.module is None:
                 # exact possible module name from metadata.name
                 module = metadata.name.rsplit('-', 1)[-1]
             else:
                 module = metadata.module
-            handle_each_section(section_header, section_type, entry_header,
-                                module)
+            yield section, get_type(section), None, module, None
 
-    # remove user-content- to enable fragment href
-    start_from = len('user-content-')
-    for anchor in soup.findAll('a'):
-        if 'id' in anchor.attrs:
-            anchor['id'] = anchor['id'][start_from:]
 
+def dash_anchor_name(section_type, api_name):
+    return '//apple_ref/cpp/%s/%s' % (section_type, quote(api_name))
+
+
+def section_digest(texts):
+    """
+    Digest of the text of an entry's section. Only the words count, not the
+    markup around them, so all parser backends give the same digest.
+    """
+    text = ' '.join(' '.join(texts).split())
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+def following_node(node, get_next, get_parent):
+    """Return the first node after node and all its descendants."""
+    while node is not None:
+        next_node = get_next(node)
+        if next_node is not None:
+            return next_node
+        node = get_parent(node)
+    return None
+
+
+def render_doc(metadata, rewritten_head, readme):
     # support online redirect
     comment = '<!-- Online page at %s -->' % metadata.url
-    doc = """<!doctype html>
+    return """<!doctype html>
         <html>%s
           <head>
             %s
@@ -344,186 +1176,1960 @@ def parse_doc_from_html(html, metadata):
             %s
           </body>
         </html>""" % (comment, rewritten_head, readme)
-    return entries, resources, doc
 
 
-def download_resources(resources,
-                       path='OpenResty.docset/Contents/Resources/Documents/'):
-    for resource in resources:
-        resource_path = path + resource.filename
-        if resource.filename.endswith('.css'):
-            with open(resource_path, 'w') as f:
-                text = get_text_from_url(resource.url)
-                f.write(text.encode('utf-8'))
-        else:  # images
-            with open(resource_path, 'wb') as f:
-                f.write(get_binary_from_url(resource.url))
-
-
-def build_docset_structure():
-    path = 'OpenResty.docset/Contents/Resources/Documents'
-    if os.path.isdir('OpenResty.docset'):
-        shutil.rmtree('OpenResty.docset')
-    os.makedirs(path)
-    write_info_plist()
-    write_sql_schema()
-    copy_icons()
-
-
-def write_info_plist(fn='OpenResty.docset/Contents/Info.plist'):
-    content = """<?xml version="1.0" encoding="UTF-8"?>
-<!DOCTYPE plist PUBLIC "-//Apple//DTD PLIST 1.0//EN" "http://www.apple.com/DTDs/PropertyList-1.0.dtd">
-<plist version="1.0">
-<dict>
-    <key>CFBundleIdentifier</key>
-    <string>{0}</string>
-    <key>CFBundleName</key>
-    <string>{1}</string>
-    <key>DocSetPlatformFamily</key>
-    <string>{0}</string>
-    <key>isDashDocset</key>
-    <true/>
-    <key>DashDocSetFamily</key>
-    <string>dashtoc</string>
-    <key>dashIndexFilePath</key>
-    <string>{2}</string>
-</dict>
-</plist>""".format('openresty', 'OpenResty', 'lua-nginx-module.html')
-    with open(fn, 'w') as f:
-        f.write(content)
+class SoupTree(object):
+    """
+    The tree API parse_doc_from_html works on, over the tree BeautifulSoup
+    builds with `parser`. LxmlTree is the same over lxml's own tree, so all
+    backends share one traversal.
+    """
 
+    def __init__(self, html, parser='html.parser'):
+        self.soup = BeautifulSoup(html, parser)
 
-def write_sql_schema(fn='OpenResty.docset/Contents/Resources/docSet.dsidx'):
-    db = sqlite3.connect(fn)
-    cur = db.cursor()
-    try:
-        cur.execute('DROP TABLE searchIndex;')
-    except Exception:
-        pass
-    cur.execute(
-        'CREATE TABLE searchIndex(id INTEGER PRIMARY KEY, name TEXT, type TEXT, path TEXT);'
-    )
-    cur.execute(
-        'CREATE UNIQUE INDEX anchor ON searchIndex (name, type, path);')
-    db.commit()
-    db.close()
+    def walk(self):
+        """
+        Yield (node, tag name, id) of every node in document order, the tag
+        name and id are None for text and comments.
+        """
+        for node in self.soup.descendants:
+            if isinstance(node, Tag):
+                yield node, node.name, node.get('id')
+            else:
+                yield node, None, None
 
+    def following(self, node):
+        return following_node(node, lambda node: node.next_sibling,
+                              lambda node: node.parent)
 
-def copy_icons(path='OpenResty.docset/'):
-    for icon in ('./icon.png', './icon@2x.png'):
-        if os.path.isfile(icon):
-            shutil.copy(icon, path)
+    def siblings(self, node):
+        """Yield (tag, tag name) of the tags after node."""
+        for sibling in node.next_siblings:
+            if isinstance(sibling, Tag):
+                yield sibling, sibling.name
 
+    def parent(self, node):
+        return node.parent
 
-def mark_duplicate_entries(entries):
-    entry_used_time = {}
-    for entry in entries:
-        entry_used_time[entry.name] = entry_used_time.setdefault(entry.name,
-                                                                 0) + 1
-    new_entries = []
-    for entry in entries:
-        if entry_used_time[entry.name] > 1:
-            name = entry.name + '(%s)' % entry.path[:entry.path.find('.html')]
-        else:
-            name = entry.name
-        new_entries.append(Entry(name=name, type=entry.type, path=entry.path))
-    return new_entries
+    def name(self, node):
+        return node.name
 
+    def get(self, node, name):
+        return node.get(name)
 
-def insert_entries(entries,
-                   fn='OpenResty.docset/Contents/Resources/docSet.dsidx'):
-    db = sqlite3.connect(fn)
-    cur = db.cursor()
-    values = [
-        "('%s', '%s', '%s')" % (entry.name, entry.type, entry.path)
-        for entry in entries
-    ]
-    for step in range(0, len(values), 500):
-        data = ','.join(values[step:step + 500])
-        # need sqlite 3.7+ to support batch insert
-        cur.execute("INSERT INTO searchIndex(name, type, path) VALUES %s" %
-                    data)
-        db.commit()
-    db.close()
+    def set(self, node, name, value):
+        node[name] = value
 
+    def rel(self, node):
+        return node.get('rel', ())
 
-def create_logger():
-    logger = logging.getLogger(__name__.split('.')[0])
-    logger.setLevel(getattr(logging, 'INFO'))
-    FORMAT = '[%(levelname)s] %(threadName)s %(message)s'
-    formatter = logging.Formatter(fmt=FORMAT)
-    handler = logging.StreamHandler(stdout)
-    handler.setFormatter(formatter)
-    logger.addHandler(handler)
-    return logger
+    def text(self, node):
+        return node.get_text()
 
+    def first_text(self, node):
+        return next(node.stripped_strings)
 
-class Worker(Thread):
-    lock = Lock()
-    path = 'OpenResty.docset/Contents/Resources/Documents/'
-    logger = create_logger()
+    def first_child(self, node):
+        return next(node.children)
 
-    @classmethod
-    def info(cls, *args):
-        cls.logger.info(*args)
+    def new_tag(self, name, attrs):
+        tag = self.soup.new_tag(name)
+        for key, value in attrs:
+            tag[key] = value
+        return tag
 
-    def __init__(self):
-        super(Worker, self).__init__()
-        self.resources = set()
-        self.entries = []
-        self.exception = None
+    def insert_before(self, node, new):
+        node.insert_before(new)
 
-    def run(self):
-        cur_url = None
+    def to_html(self, node):
+        return str(node)
 
-        try:
-            while True:
-                with Worker.lock:
-                    if len(DOCS) == 0:
-                        return
-                    doc = DOCS.pop()
-                Worker.info('Download Readme of %s' % doc.name)
-                cur_url = doc.url
-                html = get_text_from_url(cur_url)
-                # here we reassign doc's name
-                if doc.module is not None:
-                    doc.name += '-' + doc.module
-                Worker.info('Parse Readme of %s' % doc.name)
-                entries, resources, text = parse_doc_from_html(html, doc)
-                self.resources |= resources
-                self.entries.extend(entries)
-                doc_path = Worker.path + doc.name + '.html'
-                with codecs.open(doc_path, 'w', encoding='utf-8') as f:
-                    f.write(text)
-                Worker.info('Finish %s' % doc.name)
-        except Exception as e:
-            message = ''.join(traceback.format_exc())
-            Worker.info('Error happened when handling %s\n%s' %
-                        (cur_url, message))
-            self.exception = e
 
+class LxmlTree(object):
+    """SoupTree's API over lxml's own tree, which is much faster."""
 
-def interrupt_handler(*args):
-    sys.exit(0)
+    def __init__(self, html):
+        from lxml import etree
+        from lxml import html as lxml_html
+        self.etree = etree
+        self.lxml_html = lxml_html
+        self.root = lxml_html.document_fromstring(html)
 
+    def walk(self):
+        for node in self.root.iter():
+            tag = node.tag
+            # comments and processing instructions
+            if isinstance(tag, str):
+                yield node, tag, node.get('id')
+            else:
+                yield node, None, None
 
-if __name__ == '__main__':
-    build_docset_structure()
-    signal.signal(signal.SIGINT, interrupt_handler)
-    workers = [Worker() for i in range(5)]
-    for worker in workers:
-        worker.daemon = True
-        worker.start()
-    entries = []
-    resources = set()
-    for worker in workers:
-        worker.join(900)
-        if worker.exception is not None:
-            print(
-                "Some threads failed to download documents, exit with 1",
-                file=sys.stderr)
-            sys.exit(1)
-        entries.extend(worker.entries)
-        resources |= worker.resources
-    download_resources(resources)
-    insert_entries(mark_duplicate_entries(entries))
+    def following(self, node):
+        return following_node(node, lambda node: node.getnext(),
+                              lambda node: node.getparent())
+
+    def siblings(self, node):
+        for sibling in node.itersiblings():
+            if isinstance(sibling.tag, str):
+                yield sibling, sibling.tag
+
+    def parent(self, node):
+        return node.getparent()
+
+    def name(self, node):
+        return node.tag
+
+    def get(self, node, name):
+        return node.get(name)
+
+    def set(self, node, name, value):
+        node.set(name, value)
+
+    def rel(self, node):
+        return node.get('rel', '').split()
+
+    def text(self, node):
+        return ''.join(node.itertext())
+
+    def first_text(self, node):
+        return next(text.strip() for text in node.itertext() if text.strip())
+
+    def first_child(self, node):
+        return node[0]
+
+    def new_tag(self, name, attrs):
+        tag = self.etree.Element(name)
+        for key, value in attrs:
+            tag.set(key, value)
+        return tag
+
+    def insert_before(self, node, new):
+        node.addprevious(new)
+
+    def to_html(self, node):
+        return self.lxml_html.tostring(
+            node, encoding='unicode', with_tail=False)
+
+
+def parse_doc_from_html(html, metadata, parser='html.parser'):
+    """
+    Parse the document part of html page according to the metadata.
+    Return:
+    1. a list of Entries
+    2. a set of Resources
+    3. a html snippet with anchor added, resource urls rewritten,
+       useless parts removed
+    `parser` is one of PARSERS.
+    """
+    if parser == 'lxml.html':
+        tree = LxmlTree(html)
+    else:
+        tree = SoupTree(html, parser)
+
+    # collect everything we need in a single traversal
+    ids = {}
+    stylesheets = []
+    id_anchors = []
+    readme = None
+    readme_end = None
+    readme_images = []
+    readme_links = []
+    in_readme = False
+    for tag, name, tag_id in tree.walk():
+        if tag is readme_end:
+            in_readme = False
+        if name is None:
+            continue
+        if tag_id is not None and tag_id not in ids:
+            ids[tag_id] = tag
+        if name == 'a':
+            if tag_id is not None:
+                id_anchors.append(tag)
+            if in_readme:
+                readme_links.append(tag)
+        elif name == 'img':
+            if in_readme:
+                readme_images.append(tag)
+        elif name == 'link':
+            if 'stylesheet' in tree.rel(tag):
+                stylesheets.append(tag)
+        if tag_id == 'readme' and readme is None:
+            readme = tag
+            readme_end = tree.following(tag)
+            in_readme = True
+
+    resources = set()
+    rewritten_head = '<title>%s</title>\n' % metadata.name
+    for css in stylesheets:
+        link = resource_filename(tree.get(css, 'href'))
+        resources.add(Resource(filename=link, url=tree.get(css, 'href')))
+        rewritten_head += tree.to_html(
+            tree.new_tag('link', [('rel', 'stylesheet'), ('href', link)]))
+    for img in readme_images:
+        src = resource_filename(tree.get(img, 'src'))
+        resources.add(Resource(filename=src, url=tree.get(img, 'src')))
+        tree.set(img, 'src', src)
+    for link in readme_links:
+        href = rewrite_doc_link(tree.get(link, 'href'))
+        if href is not None:
+            tree.set(link, 'href', href)
+
+    entries = []
+    base_path = '%s.html' % metadata.name
+
+    def handle_each_section(section_header,
+                            section_type,
+                            entry_header,
+                            module=None):
+        """
+        Add the entries of the section, each with the digest of its part
+        of the section. Return the digest of the whole section.
+        """
+        texts = []
+        # index in entries => texts of the entry's part
+        entry_texts = {}
+        section_header_name = tree.name(section_header)
+        for tag, name in tree.siblings(section_header):
+            if name == section_header_name:
+                break
+            texts.append(tree.text(tag))
+            if name == entry_header:
+                api_name = tree.first_text(tag)
+                tag_anchor = tree.first_child(tag)
+                entry_path = base_path + tree.get(tag_anchor, 'href')
+                if section_type == 'Method':
+                    api_name = module + ':' + api_name
+                entries.append(
+                    Entry(
+                        name=api_name, type=section_type, path=entry_path))
+                # insert an anchor to support table of contents
+                anchor = tree.new_tag(
+                    'a', [('name', dash_anchor_name(section_type, api_name)),
+                          ('class', 'dashAnchor')])
+                tree.insert_before(tag_anchor, anchor)
+                entry_texts[len(entries) - 1] = []
+            if entry_texts:
+                entry_texts[len(entries) - 1].append(texts[-1])
+        for i, entry_text in entry_texts.items():
+            entries[i] = entries[i]._replace(digest=section_digest(entry_text))
+        return section_digest(texts)
+
+    for (section_id, section_type, entry_header, module,
+         class_entry) in iter_sections(metadata):
+        section_header = tree.parent(ids['user-content-' + section_id])
+        if entry_header is None:
+            # all entries' header is one level lower than section's header
+            entry_header = 'h' + str(int(tree.name(section_header)[1]) + 1)
+        if class_entry is not None:
+            entries.append(class_entry)
+            class_index = len(entries) - 1
+        digest = handle_each_section(section_header, section_type,
+                                     entry_header, module)
+        if class_entry is not None:
+            entries[class_index] = class_entry._replace(digest=digest)
+
+    # remove user-content- to enable fragment href
+    start_from = len('user-content-')
+    for anchor in id_anchors:
+        tree.set(anchor, 'id', tree.get(anchor, 'id')[start_from:])
+
+    return entries, resources, render_doc(metadata, rewritten_head,
+                                          tree.to_html(readme))
+
+
+DOCSET_PATH = 'OpenResty.docset'
+
+
+class DocsetPaths(object):
+    """
+    Paths used by the build of the docset at `path`, e.g. the docset of a
+    release. The docset is built in `staging`, and swapped into `docset`
+    once finished.
+    """
+
+    def __init__(self, path=DOCSET_PATH):
+        self.docset = path
+        self.staging = path + '.staging'
+        self.journal = path + '.journal'
+        # kept out of the docset, which is packaged as is
+        self.manifest = path + '.manifest.json'
+        self.documents = self.staging + '/Contents/Resources/Documents/'
+        self.index = self.staging + '/Contents/Resources/docSet.dsidx'
+
+
+HEADERS = ('h1', 'h2', 'h3', 'h4', 'h5', 'h6')
+
+# Forward the links to an anchor which moved into an entry's page, including
+# the ones from the other docs
+FORWARD_SCRIPT = """<script>
+            var pages = %s;
+            var page = pages[decodeURIComponent(location.hash.slice(1))];
+            if (page) location.replace(page + location.hash);
+            </script>"""
+
+
+def is_relative(url):
+    return not urlparse(url).scheme and not url.startswith(('/', '#'))
+
+
+def split_doc(html, metadata, entries, parser='html.parser'):
+    """
+    Split the page made by parse_doc_from_html into a page per entry, so
+    that opening an entry doesn't load the whole doc. The pages are put in
+    a directory named after the doc, while the doc's page keeps everything
+    else, with a link to each entry's page in place of the entry.
+    Return the entries pointing at their pages and {filename: html} of all
+    pages.
+    """
+    # BeautifulSoup has no 'lxml.html' backend, use its lxml one instead
+    soup = BeautifulSoup(html, 'lxml' if parser == 'lxml.html' else parser)
+    base_path = '%s.html' % metadata.name
+    ids = dict((tag['id'], tag) for tag in soup.find_all(id=True))
+
+    # (entry, header, page, nodes of the entry)
+    splits = []
+    taken = set()
+    for entry in entries:
+        anchor = entry.path.partition('#')[2]
+        target = ids.get(anchor)
+        # class entries are sections, whose entries are split on their own
+        if (entry.type == 'Class' or target is None
+                or target.parent.name not in HEADERS
+                or id(target.parent) in taken):
+            continue
+        header = target.parent
+        nodes = [header]
+        for tag in header.next_siblings:
+            if (getattr(tag, 'name', None) in HEADERS
+                    and tag.name <= header.name):
+                break
+            nodes.append(tag)
+        taken.update(id(node) for node in nodes)
+        splits.append((entry, header, '%s/%s.html' % (metadata.name, anchor),
+                       nodes))
+
+    # anchor => page it moved to
+    moved = {}
+    for _, _, page, nodes in splits:
+        for node in nodes:
+            if isinstance(node, Tag):
+                if node.get('id') is not None:
+                    moved[node['id']] = page
+                for tag in node.find_all(id=True):
+                    moved[tag['id']] = page
+
+    def anchor_of(href):
+        """Return the anchor if href links to this doc, else None."""
+        if href.startswith('#'):
+            return href[1:]
+        if href.startswith(base_path + '#'):
+            return href[len(base_path) + 1:]
+        return None
+
+    head = ''.join(
+        '<link rel="stylesheet" href="../%s">' % css['href']
+        for css in soup.head.find_all('link', rel='stylesheet'))
+    pages = {}
+    new_paths = {}
+    for entry, header, page, nodes in splits:
+        # link to the entry's page in place of the entry
+        index_header = soup.new_tag(header.name)
+        link = soup.new_tag('a', href=page)
+        link.string = header.get_text().strip()
+        index_header.append(link)
+        header.insert_before(index_header)
+
+        # keep the ancestors of the entry, so the page has the same styles
+        body = container = None
+        for ancestor in reversed(list(header.parents)):
+            if ancestor.name in ('[document]', 'html', 'body'):
+                continue
+            copy = soup.new_tag(ancestor.name, attrs=dict(ancestor.attrs))
+            if container is None:
+                body = copy
+            else:
+                container.append(copy)
+            container = copy
+        for node in nodes:
+            container.append(node.extract())
+
+        for tag in body.find_all('a', href=True):
+            href = tag['href']
+            anchor = anchor_of(href)
+            if anchor is None:
+                if is_relative(href):
+                    tag['href'] = '../' + href
+            elif moved.get(anchor) != page:
+                if anchor in moved:
+                    tag['href'] = '%s#%s' % (
+                        moved[anchor].rpartition('/')[2], anchor)
+                else:
+                    tag['href'] = '../%s#%s' % (base_path, anchor)
+        for tag in body.find_all('img', src=True):
+            if is_relative(tag['src']):
+                tag['src'] = '../' + tag['src']
+
+        title = '<title>%s</title>\n' % entry.name
+        pages[page] = render_doc(metadata, title + head, str(body))
+        new_paths[entry.path] = page
+
+    for tag in soup.body.find_all('a', href=True):
+        anchor = anchor_of(tag['href'])
+        if anchor in moved:
+            tag['href'] = '%s#%s' % (moved[anchor], anchor)
+    script = BeautifulSoup(FORWARD_SCRIPT % json.dumps(moved, sort_keys=True),
+                           'html.parser')
+    soup.head.append(script)
+    pages[base_path] = str(soup)
+    entries = [
+        entry._replace(path=new_paths.get(entry.path, entry.path))
+        for entry in entries
+    ]
+    return entries, pages
+
+
+# GitHub's UI left inside #readme
+CHROME_SELECTORS = ('.Box-header', 'a.anchor > svg', 'svg.octicon',
+                    'clipboard-copy', 'details-menu')
+# The pruned stylesheet shared by all pages of a compacted docset
+STYLESHEET = 'docset.css'
+# Whitespace is kept as it is in these tags
+PREFORMATTED = ('pre', 'code', 'textarea', 'script', 'style')
+# Whitespace in html and css, unlike \s it doesn't match the no-break space
+# of &nbsp;, which renders
+SPACES = r'[ \t\n\r\f]+'
+# Whitespace between these tags doesn't render
+BLOCKS = frozenset(HEADERS + (
+    'html', 'head', 'body', 'title', 'link', 'meta', 'style', 'script',
+    'div', 'article', 'section', 'p', 'pre', 'blockquote', 'hr', 'ul', 'ol',
+    'li', 'dl', 'dt', 'dd', 'table', 'thead', 'tbody', 'tr', 'th', 'td'))
+BLOCK_EDGES = BLOCKS | frozenset([None])
+
+
+def compact_page(html, fn, parser='html.parser'):
+    """
+    Strip GitHub's chrome from the page fn, link it to the shared STYLESHEET
+    instead of GitHub's ones, and remove the whitespace and comments which
+    don't change how it renders. The comment with the online page is kept
+    for Dash.
+    """
+    soup = BeautifulSoup(html, 'lxml' if parser == 'lxml.html' else parser)
+    for selector in CHROME_SELECTORS:
+        for tag in soup.select(selector):
+            tag.decompose()
+    links = soup.find_all('link', rel='stylesheet')
+    if links:
+        stylesheet = soup.new_tag(
+            'link', rel='stylesheet', href='../' * fn.count('/') + STYLESHEET)
+        links[0].insert_before(stylesheet)
+        for link in links:
+            link.decompose()
+    for string in list(soup.find_all(string=True)):
+        if isinstance(string, Doctype):
+            continue
+        if isinstance(string, Comment):
+            if not string.startswith(' Online page at '):
+                string.extract()
+            continue
+        if string.parent.name == 'style':
+            string.replace_with(_minify_declarations(string))
+            continue
+        if any(parent.name in PREFORMATTED for parent in string.parents):
+            continue
+        text = re.sub(SPACES, ' ', string)
+        if text == ' ':
+            previous = string.previous_sibling
+            following = string.next_sibling
+            if (string.parent.name in BLOCKS
+                    and getattr(previous, 'name', None) in BLOCK_EDGES
+                    and getattr(following, 'name', None) in BLOCK_EDGES):
+                string.extract()
+                continue
+        if text != string:
+            string.replace_with(text)
+    return str(soup)
+
+
+def used_selectors(path):
+    """
+    Return (tags, classes, ids) used by the html pages under path, which are
+    written by BeautifulSoup, so attributes are always double quoted.
+    """
+    tags = set()
+    classes = set()
+    ids = set()
+    for root, _, files in os.walk(path):
+        for fn in files:
+            if not fn.endswith('.html'):
+                continue
+            with codecs.open(os.path.join(root, fn), 'r',
+                             encoding='utf-8') as f:
+                html = f.read()
+            tags.update(tag.lower() for tag in re.findall(
+                r'<([a-zA-Z][\w-]*)', html))
+            for names in re.findall(r'\sclass="([^"]*)"', html):
+                classes.update(names.split())
+            ids.update(re.findall(r'\sid="([^"]*)"', html))
+    return tags, classes, ids
+
+
+def _css_blocks(css):
+    """
+    Yield (prelude, body) of each rule in css, body is None for statements
+    like @charset. Strings are skipped when matching the braces.
+    """
+    start = i = 0
+    while i < len(css):
+        c = css[i]
+        if c in '"\'':
+            i = css.find(c, i + 1)
+            if i == -1:
+                return
+        elif c == ';' and css[start:i].strip().startswith('@'):
+            yield css[start:i].strip(), None
+            start = i + 1
+        elif c == '{':
+            prelude = css[start:i].strip()
+            depth = 1
+            j = i + 1
+            while j < len(css) and depth:
+                if css[j] in '"\'':
+                    j = css.find(css[j], j + 1)
+                    if j == -1:
+                        return
+                elif css[j] == '{':
+                    depth += 1
+                elif css[j] == '}':
+                    depth -= 1
+                j += 1
+            yield prelude, css[i + 1:j - 1]
+            start = i = j
+            continue
+        elif c == '}':
+            # stray brace of broken css
+            start = i + 1
+        i += 1
+
+
+def _split_selectors(prelude):
+    """Split a selector list by its top-level commas."""
+    selectors = []
+    depth = 0
+    start = 0
+    for i, c in enumerate(prelude):
+        if c in '([':
+            depth += 1
+        elif c in ')]':
+            depth -= 1
+        elif c == ',' and depth == 0:
+            selectors.append(prelude[start:i].strip())
+            start = i + 1
+    selectors.append(prelude[start:].strip())
+    return selectors
+
+
+def _selector_used(selector, used):
+    tags, classes, ids = used
+    # pseudo-classes and attributes can't be checked statically, so they
+    # are ignored, which only keeps more rules
+    selector = re.sub(r'\[[^\]]*\]', '', selector)
+    selector = re.sub(r'(?<!\\)::?[\w-]+(\([^)]*\))?', '', selector)
+    for name in re.findall(r'\.((?:[\w-]|\\.)+)', selector):
+        if re.sub(r'\\(.)', r'\1', name) not in classes:
+            return False
+    for name in re.findall(r'#((?:[\w-]|\\.)+)', selector):
+        if re.sub(r'\\(.)', r'\1', name) not in ids:
+            return False
+    for name in re.findall(r'(?:^|[\s>+~])([a-zA-Z][\w-]*)', selector):
+        if name.lower() not in tags:
+            return False
+    return True
+
+
+# A quoted css string, with its escapes
+CSS_STRING = r'"(?:[^"\\]|\\.)*"|\'(?:[^\'\\]|\\.)*\''
+
+
+def _outside_strings(css, minify):
+    """Apply minify to the parts of css which aren't in strings."""
+    parts = re.split('(%s)' % CSS_STRING, css, flags=re.S)
+    parts[::2] = [minify(part) for part in parts[::2]]
+    return ''.join(parts)
+
+
+def _minify_declarations(body):
+    """
+    Collapse the whitespace of css and remove it around punctuation, but
+    not before ':', which starts a pseudo-class in selectors.
+    """
+
+    def minify(css):
+        return re.sub(r' ?([;,{}]) ?|: ', lambda m: m.group(1) or ':',
+                      re.sub(SPACES, ' ', css))
+
+    return _outside_strings(body.strip(' \t\n\r\f'), minify)
+
+
+# At-rules whose block holds rules, which are pruned like the top-level ones
+GROUPING_RULES = ('@media', '@supports', '@container', '@layer', '@scope',
+                  '@document', '@-moz-document', '@starting-style')
+
+
+def prune_css(css, used):
+    """
+    Keep the rules of css whose selectors match something `used`, see
+    used_selectors, and minify them. The rules in GROUPING_RULES are
+    pruned too, while unknown at-rules are kept as they are.
+    """
+    css = re.sub(r'/\*.*?\*/', '', css, flags=re.S)
+    rules = []
+    # @font-face and @keyframes are kept if the kept rules use them
+    named = []
+    for prelude, body in _css_blocks(css):
+        prelude = _outside_strings(prelude,
+                                   lambda css: re.sub(SPACES, ' ', css))
+        if body is None:
+            # only meaningful at the start of each source stylesheet
+            if not prelude.startswith('@charset'):
+                rules.append(prelude + ';')
+            continue
+        if re.match(r'(%s)\b' % '|'.join(GROUPING_RULES), prelude):
+            body = prune_css(body, used)
+            # an empty layer still sets where its name is in the layer order
+            if body or prelude.startswith('@layer'):
+                rules.append('%s{%s}' % (prelude, body))
+        elif prelude.startswith('@font-face'):
+            family = re.search(r'font-family\s*:\s*([^;]+)', body)
+            named.append((family.group(1).strip(' \'"') if family else None,
+                          prelude, body))
+        elif re.match(r'@(-\w+-)?keyframes', prelude):
+            named.append((prelude.split()[-1], prelude, body))
+        elif prelude.startswith('@'):
+            rules.append('%s{%s}' % (prelude, body))
+        else:
+            selectors = [
+                selector for selector in _split_selectors(prelude)
+                if _selector_used(selector, used)
+            ]
+            if selectors:
+                body = _minify_declarations(body)
+                rules.append('%s{%s}' % (','.join(selectors), body))
+    # identical rules override each other, the last one is enough, but
+    # where a layer first appears sets its place in the layer order
+    last = dict((rule, i) for i, rule in enumerate(rules))
+    rules = [
+        rule for i, rule in enumerate(rules)
+        if last[rule] == i or rule.startswith('@layer')
+    ]
+    kept = ''.join(rules)
+    # after the statements which have to come first, or they are ignored
+    head = 0
+    while head < len(rules) and re.match(r'@(import|namespace|layer)\b[^{]*;$',
+                                         rules[head]):
+        head += 1
+    rules[head:head] = [
+        '%s{%s}' % (prelude, _minify_declarations(body))
+        for name, prelude, body in named if name and name in kept
+    ]
+    return ''.join(rules)
+
+
+def merge_orders(orders):
+    """
+    Merge lists into one which keeps the order of each of them. Items
+    which aren't ordered by any list, or whose lists disagree, come in the
+    order they are first seen.
+    """
+    first_seen = {}
+    # item => items which come after it
+    after = {}
+    before_count = {}
+    for order in orders:
+        for i, item in enumerate(order):
+            first_seen.setdefault(item, len(first_seen))
+            after.setdefault(item, set())
+            before_count.setdefault(item, 0)
+            if i and item != order[i - 1] and item not in after[order[i - 1]]:
+                after[order[i - 1]].add(item)
+                before_count[item] += 1
+    merged = []
+    left = sorted(first_seen, key=first_seen.get)
+    while left:
+        ready = [item for item in left if not before_count[item]]
+        # a cycle of disagreeing lists is broken at its first seen item
+        item = ready[0] if ready else left[0]
+        merged.append(item)
+        left.remove(item)
+        for following in after[item]:
+            before_count[following] -= 1
+    return merged
+
+
+def compact_stylesheet(path, order=()):
+    """
+    Prune GitHub's stylesheets downloaded in this build into the shared
+    STYLESHEET, then remove them. They are joined in `order`, the order
+    the pages link them in, see Manifest.stylesheets, as later rules
+    override earlier ones. Return (bytes before, bytes after), or None if
+    no stylesheet was downloaded, as no page has changed.
+    """
+    sources = set(fn for fn in os.listdir(path)
+                  if fn.endswith('.css') and fn != STYLESHEET)
+    if not sources:
+        return None
+    sources = [fn for fn in order if fn in sources] + sorted(
+        sources - set(order))
+    css = ''
+    for fn in sources:
+        with codecs.open(path + fn, 'r', encoding='utf-8') as f:
+            css += f.read() + '\n'
+    pruned = prune_css(css, used_selectors(path))
+    with codecs.open(path + STYLESHEET + '.tmp', 'w', encoding='utf-8') as f:
+        f.write(pruned)
+    os.rename(path + STYLESHEET + '.tmp', path + STYLESHEET)
+    for fn in sources:
+        os.remove(path + fn)
+    return len(css.encode('utf-8')), len(pruned.encode('utf-8'))
+
+
+with open(__file__, 'rb') as f:
+    # parse results depend on the code producing them
+    CODE_DIGEST = hashlib.sha1(f.read()).hexdigest()
+
+
+def doc_digest(html,
+               metadata,
+               parser='html.parser',
+               split=False,
+               compact=False):
+    """Digest of everything the pages of the doc depend on."""
+    h = hashlib.sha1(CODE_DIGEST.encode('utf-8'))
+    h.update(parser.encode('utf-8'))
+    h.update(b'split' if split else b'')
+    h.update(b'compact' if compact else b'')
+    h.update(metadata.name.encode('utf-8'))
+    h.update(metadata.url.encode('utf-8'))
+    h.update(' '.join(metadata.sections).encode('utf-8'))
+    h.update(html.encode('utf-8'))
+    return h.hexdigest()
+
+
+class ParseCache(object):
+    """
+    Memoize parse_doc_from_html by doc_digest, so refetching a page with
+    identical content doesn't need to parse it again.
+    Results not used for max_age seconds are removed.
+    """
+
+    def __init__(self, path, max_age=30 * 24 * 3600):
+        self.path = path
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        now = time.time()
+        for fn in os.listdir(path):
+            fn = os.path.join(path, fn)
+            if os.path.getmtime(fn) < now - max_age:
+                os.remove(fn)
+
+    def get(self, digest):
+        fn = os.path.join(self.path, digest + '.json')
+        try:
+            with codecs.open(fn, 'r', encoding='utf-8') as f:
+                result = json.load(f)
+        except (IOError, ValueError):
+            return None
+        os.utime(fn, None)
+        entries = [Entry(*entry) for entry in result['entries']]
+        resources = set(Resource(*res) for res in result['resources'])
+        return entries, resources, result['pages'], result['stylesheets']
+
+    def put(self, digest, result):
+        entries, resources, pages, stylesheets = result
+        fn = os.path.join(self.path, digest + '.json')
+        with codecs.open(fn + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump({
+                'entries': entries,
+                'resources': sorted(resources),
+                'pages': pages,
+                'stylesheets': stylesheets,
+            }, f)
+        os.rename(fn + '.tmp', fn)
+
+
+def ignore_interrupt():
+    """Leave Ctrl-C to the main process, which shuts the parse pool down."""
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def parse_in_process(html,
+                     name,
+                     url,
+                     sections,
+                     parser='html.parser',
+                     profile=False,
+                     split=False,
+                     compact=False):
+    """
+    Run parse_doc_from_html in a parse process, then split_doc with `split`
+    and compact_page with `compact`. Only builtin types are passed in and
+    out, so nothing but the html and the result is pickled. The pages are
+    returned as {filename: html}, with the stylesheets in the order the
+    doc links them and (bytes before, bytes after) of compacting them.
+    With `profile`, the cProfile stats of parsing are returned too.
+    """
+    metadata = Doc(name, url, sections)
+    profiler = None
+    if profile:
+        profiler = cProfile.Profile()
+        profiler.enable()
+    entries, resources, doc = parse_doc_from_html(html, metadata, parser)
+    # compact_page removes the links, which are in the head, first
+    stylesheets = sorted(
+        (res.filename for res in resources if res.filename.endswith('.css')),
+        key=doc.find)
+    if split:
+        entries, pages = split_doc(doc, metadata, entries, parser)
+    else:
+        pages = {name + '.html': doc}
+    before = after = sum(len(text.encode('utf-8')) for text in pages.values())
+    if compact:
+        pages = dict((fn, compact_page(text, fn, parser))
+                     for fn, text in pages.items())
+        after = sum(len(text.encode('utf-8')) for text in pages.values())
+    stats = None
+    if profiler is not None:
+        profiler.disable()
+        profiler.create_stats()
+        stats = profiler.stats
+    return ([tuple(entry) for entry in entries],
+            [tuple(resource) for resource in resources], pages, stylesheets,
+            (before, after), stats)
+
+
+def download_resource(resource, path, fetcher, store=None):
+    """Download resource under path with fetcher, through store if given."""
+    if store is not None:
+        store.download(resource.url, path + resource.filename, fetcher)
+    else:
+        fetcher.download_to_file(resource.url, path + resource.filename)
+
+
+def download_resources(resources,
+                       path,
+                       fetcher,
+                       store=None,
+                       concurrency=CONCURRENCY):
+    """Download resources concurrently, each url once."""
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = [
+            executor.submit(download_resource, resource, path, fetcher,
+                            store) for resource in set(resources)
+        ]
+        for future in futures:
+            future.result()
+
+
+class Manifest(object):
+    """
+    Record what each doc contributed to the docset in the previous builds:
+    the digest of its input, the files written for it and the stylesheets
+    it links, in order. Its entries are in the index already.
+    Docs are keyed by url, as several docs share the same name. The
+    records of the previous builds are only loaded with `load`.
+    """
+
+    def __init__(self, fn, load=False):
+        self.fn = fn
+        self.lock = Lock()
+        self.docs = {}
+        self.previous = {}
+        if load and os.path.isfile(fn):
+            with open(fn) as f:
+                self.docs = json.load(f)
+            self.previous = dict(self.docs)
+
+    def is_fresh(self, url, digest, path):
+        with self.lock:
+            record = self.docs.get(url)
+        if record is None or record['digest'] != digest:
+            return False
+        return all(os.path.isfile(path + fn) for fn in record['files'])
+
+    def update(self, url, name, digest, files, stylesheets):
+        with self.lock:
+            self.docs[url] = {
+                'name': name,
+                'digest': digest,
+                'files': sorted(files),
+                'stylesheets': stylesheets,
+            }
+
+    def stylesheets(self):
+        """
+        The stylesheets of all docs in the order the docs link them, so an
+        incremental build joins them like a full one.
+        """
+        with self.lock:
+            return merge_orders(self.docs[url].get('stylesheets', [])
+                                for url in sorted(self.docs))
+
+    def forget_except(self, urls):
+        """
+        Drop the records of docs which are not in urls any more, return
+        their names.
+        """
+        names = []
+        with self.lock:
+            for url in list(self.docs):
+                if url not in urls:
+                    names.append(self.docs.pop(url)['name'])
+        return names
+
+    def stale_files(self):
+        """Files written by previous builds which no doc references now."""
+        with self.lock:
+            used = set(fn for record in self.docs.values()
+                       for fn in record['files'])
+            return set(fn for record in self.previous.values()
+                       for fn in record['files']) - used
+
+    def save(self):
+        with self.lock:
+            with open(self.fn + '.tmp', 'w') as f:
+                json.dump(self.docs, f, sort_keys=True)
+            os.rename(self.fn + '.tmp', self.fn)
+
+
+class Journal(object):
+    """
+    Write-ahead log of the build in the staging docset. Each doc is recorded
+    once its page is written, with its digest, entries and resources, and
+    each resource once it is downloaded. Every record is flushed to disk on
+    its own, so a build interrupted at any point is resumed from the last
+    one. The journal only applies to a build with the same options.
+    """
+
+    def __init__(self, fn, options=None, resume=False):
+        self.fn = fn
+        self.lock = Lock()
+        # url => record of the doc
+        self.docs = {}
+        # filenames of downloaded resources
+        self.resources = set()
+        header = {'options': options}
+        records = []
+        size = 0
+        if resume and os.path.isfile(fn):
+            with open(fn, 'rb') as f:
+                for line in f:
+                    # the last record may be cut short by a crash
+                    if not line.endswith(b'\n'):
+                        break
+                    try:
+                        records.append(json.loads(line.decode('utf-8')))
+                    except ValueError:
+                        break
+                    size += len(line)
+        self.resumed = bool(records) and records[0] == header
+        if self.resumed:
+            for record in records[1:]:
+                if 'doc' in record:
+                    self.docs[record['doc']] = record
+                else:
+                    self.resources.add(record['resource'])
+            os.truncate(fn, size)
+            self.f = open(fn, 'ab')
+        else:
+            self.f = open(fn, 'wb')
+            self._append(header)
+
+    def _append(self, record):
+        with self.lock:
+            self.f.write(json.dumps(record).encode('utf-8') + b'\n')
+            self.f.flush()
+            os.fsync(self.f.fileno())
+
+    def doc(self, url):
+        """Return the record of the written doc, or None."""
+        with self.lock:
+            return self.docs.get(url)
+
+    def add_doc(self, url, name, digest, files, entries, resources,
+                stylesheets):
+        record = {
+            'doc': url,
+            'name': name,
+            'digest': digest,
+            'files': sorted(files),
+            'entries': entries,
+            'resources': sorted(resources),
+            'stylesheets': stylesheets,
+        }
+        self._append(record)
+        with self.lock:
+            self.docs[url] = record
+
+    def has_resource(self, resource, path):
+        with self.lock:
+            if resource.filename not in self.resources:
+                return False
+        return os.path.isfile(path + resource.filename)
+
+    def add_resource(self, resource):
+        self._append({'resource': resource.filename})
+        with self.lock:
+            self.resources.add(resource.filename)
+
+    def close(self):
+        self.f.close()
+
+
+class DocsetBuild(object):
+    """
+    What the stages of the build of one docset share: its `paths`, the
+    `fetcher`, which counts its retries in its `stats`, the `manifest` and
+    `journal` recording its docs, and the caches shared by all builds,
+    `parse_cache` and `resource_store`. Those are None if not used.
+    """
+
+    def __init__(self,
+                 paths,
+                 fetcher,
+                 stats=None,
+                 manifest=None,
+                 journal=None,
+                 parse_cache=None,
+                 resource_store=None):
+        self.paths = paths
+        self.stats = stats or BuildStats()
+        self.fetcher = fetcher.with_stats(self.stats)
+        self.manifest = manifest
+        self.journal = journal
+        self.parse_cache = parse_cache
+        self.resource_store = resource_store
+
+
+def _copy_file(src, dst):
+    """
+    Copy src, but link it if it is linked from the resource store, as
+    resources are replaced instead of being written in place.
+    """
+    if os.stat(src).st_nlink > 1:
+        try:
+            os.link(src, dst)
+            return dst
+        except OSError:
+            pass
+    return shutil.copy2(src, dst)
+
+
+def build_docset_structure(paths, incremental=False, resume=False,
+                           release=None):
+    """
+    Set up the staging docset of `paths` for the OpenResty `release`. An
+    incremental build starts from a copy of the current docset, a resumed
+    one from what the interrupted build left.
+    """
+    if resume:
+        # the index isn't written durably, so it is restored and the
+        # entries in the journal are inserted again
+        if os.path.isfile(paths.index):
+            os.remove(paths.index)
+        current_index = paths.docset + '/Contents/Resources/docSet.dsidx'
+        if incremental and os.path.isfile(current_index):
+            shutil.copyfile(current_index, paths.index)
+            write_sql_schema(paths.index, reset=False)
+        else:
+            write_sql_schema(paths.index)
+        return
+    if os.path.isdir(paths.staging):
+        shutil.rmtree(paths.staging)
+    plist = paths.staging + '/Contents/Info.plist'
+    if incremental and os.path.isdir(paths.docset):
+        shutil.copytree(paths.docset, paths.staging, copy_function=_copy_file)
+        # written into the docset by older builds
+        legacy = paths.staging + '/Contents/Resources/manifest.json'
+        if os.path.isfile(legacy):
+            os.remove(legacy)
+        write_info_plist(plist, release)
+        write_sql_schema(paths.index, reset=False)
+        copy_icons(paths.staging + '/')
+        return
+    os.makedirs(paths.documents)
+    write_info_plist(plist, release)
+    write_sql_schema(paths.index)
+    copy_icons(paths.staging + '/')
+
+
+def exchange_paths(a, b):
+    """
+    Exchange the paths a and b in one atomic step, with renameat2 on Linux
+    and renamex_np on macOS. Return False if the system or file system
+    can't.
+    """
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+    except OSError:
+        return False
+    if hasattr(libc, 'renameat2'):
+        # AT_FDCWD, RENAME_EXCHANGE
+        result = libc.renameat2(-100, os.fsencode(a), -100, os.fsencode(b), 2)
+    elif hasattr(libc, 'renamex_np'):
+        # RENAME_SWAP
+        result = libc.renamex_np(os.fsencode(a), os.fsencode(b), 2)
+    else:
+        return False
+    if result != 0:
+        error = ctypes.get_errno()
+        if error in (errno.EINVAL, errno.ENOSYS, errno.ENOTSUP):
+            return False
+        raise OSError(error, os.strerror(error), a)
+    return True
+
+
+def swap_docset(staging, path):
+    """
+    Replace the docset with the finished staging one. Where exchange_paths
+    works, readers like Dash always find either the old docset or the new
+    one; elsewhere there is no docset between two renames. The old docset
+    is only removed once the new one is in place.
+    """
+    old = path + '.old'
+    if os.path.isdir(old):
+        shutil.rmtree(old)
+    if os.path.isdir(path) and exchange_paths(staging, path):
+        # staging isn't left behind for --resume to pick up
+        os.rename(staging, old)
+    else:
+        if os.path.isdir(path):
+            os.rename(path, old)
+        os.rename(staging, path)
+    if os.path.isdir(old):
+        shutil.rmtree(old)
+
+
+def write_info_plist(fn, release=None):
+    """
+    The docset of a release is named after it, and can be installed next
+    to the others, while all of them share the `openresty` keyword.
+    """
+    identifier = 'openresty'
+    name = 'OpenResty'
+    if release is not None:
+        identifier += '-' + release
+        name += ' ' + release
+    content = """<?xml version="1.0" encoding="UTF-8"?>
+<!DOCTYPE plist PUBLIC "-//Apple//DTD PLIST 1.0//EN" "http://www.apple.com/DTDs/PropertyList-1.0.dtd">
+<plist version="1.0">
+<dict>
+    <key>CFBundleIdentifier</key>
+    <string>{0}</string>
+    <key>CFBundleName</key>
+    <string>{1}</string>
+    <key>DocSetPlatformFamily</key>
+    <string>{3}</string>
+    <key>isDashDocset</key>
+    <true/>
+    <key>DashDocSetFamily</key>
+    <string>dashtoc</string>
+    <key>dashIndexFilePath</key>
+    <string>{2}</string>
+</dict>
+</plist>""".format(identifier, name, 'lua-nginx-module.html', 'openresty')
+    with open(fn, 'w') as f:
+        f.write(content)
+
+
+def connect_index(fn):
+    """
+    Open the search index for writing. Durability is traded for speed, as
+    an interrupted build is redone anyway.
+    """
+    db = sqlite3.connect(fn)
+    db.execute('PRAGMA journal_mode = MEMORY;')
+    db.execute('PRAGMA synchronous = OFF;')
+    return db
+
+
+def write_sql_schema(fn, reset=True):
+    db = connect_index(fn)
+    cur = db.cursor()
+    if reset:
+        cur.execute('DROP TABLE IF EXISTS searchIndex;')
+        cur.execute('DROP TABLE IF EXISTS entryDigest;')
+    # only takes effect before the first table is created
+    cur.execute('PRAGMA page_size = 4096;')
+    # the unique index is created by optimize_index after the bulk load
+    cur.execute(
+        'CREATE TABLE IF NOT EXISTS searchIndex(id INTEGER PRIMARY KEY, name TEXT, type TEXT, path TEXT);'
+    )
+    # section_digest of each entry, which Dash doesn't know about, so that
+    # diff_entries.py can tell the entries whose documentation changed
+    cur.execute(
+        'CREATE TABLE IF NOT EXISTS entryDigest(type TEXT, path TEXT, digest TEXT, PRIMARY KEY (type, path)) WITHOUT ROWID;'
+    )
+    db.commit()
+    db.close()
+
+
+def optimize_index(fn):
+    """
+    Rewrite the index into a new file once all entries are inserted: rows
+    are sorted and numbered in that order, then the unique index is created
+    and analyzed. The same entries always give the same compact file,
+    whatever order the docs were written in.
+    """
+    tmp = fn + '.tmp'
+    if os.path.isfile(tmp):
+        os.remove(tmp)
+    write_sql_schema(tmp)
+    db = connect_index(tmp)
+    db.execute('ATTACH DATABASE ? AS built;', (fn, ))
+    db.execute('INSERT INTO searchIndex(name, type, path) '
+               'SELECT name, type, path FROM built.searchIndex '
+               'ORDER BY name, type, path;')
+    db.execute('INSERT INTO entryDigest(type, path, digest) '
+               'SELECT type, path, digest FROM built.entryDigest '
+               'ORDER BY type, path;')
+    db.commit()
+    db.execute('DETACH DATABASE built;')
+    db.execute(
+        'CREATE UNIQUE INDEX IF NOT EXISTS anchor ON searchIndex (name, type, path);'
+    )
+    db.execute('ANALYZE;')
+    db.commit()
+    db.close()
+    os.rename(tmp, fn)
+
+
+# Modification time of all files of the docset, so the same content always
+# gives the same docset and package
+BUILD_MTIME = int(os.environ.get('SOURCE_DATE_EPOCH', 315532800))
+
+
+def normalize_mtimes(path, mtime=BUILD_MTIME):
+    for root, dirs, files in os.walk(path):
+        for name in dirs + files:
+            os.utime(os.path.join(root, name), (mtime, mtime))
+    os.utime(path, (mtime, mtime))
+
+
+def copy_icons(path):
+    for icon in ('./icon.png', './icon@2x.png'):
+        if os.path.isfile(icon):
+            shutil.copy(icon, path)
+
+
+def mark_duplicate_entries(db):
+    """
+    Append '(doc name)' to the names shared by several entries. Names marked
+    by a previous build are restored first, as the duplicates may differ.
+    """
+    # the doc name is the part of path before '.html', or before '/' for the
+    # pages of split docs
+    end = "instr(replace(path, '/', '.html'), '.html')"
+    doc = "substr(path, 1, %s - 1)" % end
+    suffix_len = "(%s + 1)" % end
+    db.execute('UPDATE searchIndex SET name = substr(name, 1, length(name) - '
+               '{1}) WHERE substr(name, -{1}) = \'(\' || {0} || \')\';'.format(
+                   doc, suffix_len))
+    db.execute(
+        'UPDATE searchIndex SET name = name || \'(\' || {0} || \')\' '
+        'WHERE name IN (SELECT name FROM searchIndex GROUP BY name '
+        'HAVING count(*) > 1);'.format(doc))
+
+
+def write_entries(db, entries):
+    """Insert the entries, and their digests into the side table."""
+    db.executemany(
+        'INSERT INTO searchIndex(name, type, path) VALUES (?, ?, ?)',
+        [entry[:3] for entry in entries])
+    db.executemany(
+        'INSERT OR REPLACE INTO entryDigest(type, path, digest) '
+        'VALUES (?, ?, ?)', [(entry.type, entry.path, entry.digest)
+                             for entry in entries if entry.digest])
+
+
+def insert_entries(entries, fn):
+    db = connect_index(fn)
+    # all rows in one transaction
+    with db:
+        write_entries(db, entries)
+    db.close()
+
+
+class IndexWriter(Thread):
+    """
+    The only writer of the search index. The entries of each doc are queued
+    as soon as the doc is parsed and inserted in this thread, so writing
+    overlaps with fetching and parsing. When closed, duplicate names are
+    marked and everything is committed in one transaction.
+    With `replace` the previous rows of each doc are deleted first. The
+    time spent is counted in `stats`.
+    """
+
+    def __init__(self, fn, replace=False, stats=None):
+        super(IndexWriter, self).__init__()
+        self.daemon = True
+        self.fn = fn
+        self.replace = replace
+        self.stats = stats or BuildStats()
+        self.queue = queue.Queue()
+        self.exception = None
+
+    def write(self, name, entries):
+        """Queue the entries of doc `name`, [] to remove the doc."""
+        self.queue.put((name, entries, time.time()))
+
+    def close(self):
+        self.queue.put(None)
+        self.join()
+        if self.exception is not None:
+            raise self.exception
+
+    def run(self):
+        db = connect_index(self.fn)
+        try:
+            while True:
+                item = self.queue.get()
+                if item is None:
+                    break
+                name, entries, queued_at = item
+                self.stats.add(
+                    self.stats.docs, name, index_wait=time.time() - queued_at)
+                with self.stats.span('insert', self.stats.docs, name):
+                    if self.replace:
+                        for prefix in (name + '.html', name + '/'):
+                            for table in ('searchIndex', 'entryDigest'):
+                                db.execute(
+                                    'DELETE FROM %s WHERE substr(path, 1, ?) = ?'
+                                    % table, (len(prefix), prefix))
+                    write_entries(db, entries)
+            with self.stats.span('mark_duplicates'):
+                mark_duplicate_entries(db)
+                db.commit()
+        except Exception as e:
+            info('Error happened when writing %s\n%s' %
+                 (self.fn, traceback.format_exc()))
+            self.exception = e
+        finally:
+            db.close()
+
+
+def create_logger():
+    logger = logging.getLogger(__name__.split('.')[0])
+    logger.setLevel(getattr(logging, 'INFO'))
+    FORMAT = '[%(levelname)s] %(threadName)s %(message)s'
+    formatter = logging.Formatter(fmt=FORMAT)
+    handler = logging.StreamHandler(stdout)
+    handler.setFormatter(formatter)
+    logger.addHandler(handler)
+    return logger
+
+
+LOGGER = create_logger()
+
+
+def info(*args):
+    LOGGER.info(*args)
+
+
+def check_doc(doc,
+              html,
+              build,
+              parser='html.parser',
+              split=False,
+              compact=False):
+    """
+    Return the digest of the fetched doc, or None if the doc hasn't changed
+    since the last build.
+    """
+    # here we reassign doc's name
+    doc.reassign_name()
+    digest = doc_digest(html, doc, parser, split, compact)
+    manifest = build.manifest
+    if manifest is not None and manifest.is_fresh(doc.url, digest,
+                                                  build.paths.documents):
+        info('Skip unchanged %s' % doc.name)
+        return None
+    return digest
+
+
+def save_doc(doc, digest, result, build, compact=False):
+    """
+    Write the parsed doc into the docset of build and record it. With
+    `compact` the stylesheets aren't part of the docset, see
+    compact_stylesheet.
+    """
+    entries, resources, pages, stylesheets = result
+    path = build.paths.documents
+    with build.stats.span('write', build.stats.docs, doc.name):
+        for fn, text in pages.items():
+            dirname = os.path.dirname(path + fn)
+            if not os.path.isdir(dirname):
+                os.makedirs(dirname)
+            with codecs.open(path + fn, 'w', encoding='utf-8') as f:
+                f.write(text)
+    files = list(pages) + [
+        res.filename for res in resources
+        if not (compact and res.filename.endswith('.css'))
+    ]
+    if build.manifest is not None:
+        build.manifest.update(doc.url, doc.name, digest, files, stylesheets)
+    if build.journal is not None:
+        build.journal.add_doc(doc.url, doc.name, digest, files, entries,
+                              resources, stylesheets)
+    info('Finish %s' % doc.name)
+
+
+def resume_doc(doc, build):
+    """
+    Return (entries, resources) of the doc written before the build was
+    interrupted, or None if it has to be handled again.
+    """
+    path = build.paths.documents
+    record = (build.journal.doc(doc.url)
+              if build.journal is not None else None)
+    if record is None or not all(
+            os.path.isfile(path + fn) for fn in record['files']):
+        return None
+    entries = [Entry(*entry) for entry in record['entries']]
+    resources = set(Resource(*res) for res in record['resources'])
+    if build.manifest is not None:
+        build.manifest.update(doc.url, record['name'], record['digest'],
+                              record['files'], record.get('stylesheets', []))
+    info('Resume %s' % doc.name)
+    return entries, resources
+
+
+def load_history(fn):
+    """
+    Return {doc name: (bytes, parse seconds)} from the report of a previous
+    build, see update_history. Fetch times aren't kept: they are mostly
+    spent waiting for the rate limiter or revalidating an unchanged page.
+    """
+    try:
+        with open(fn) as f:
+            report = json.load(f)
+    except (IOError, ValueError):
+        return {}
+    # reports older than the history only have the docs of their build
+    docs = report.get('history') or report.get('docs', {})
+    return dict((name, (counters.get('bytes'), counters.get('parse')))
+                for name, counters in docs.items())
+
+
+def update_history(history, docs):
+    """
+    Return the history of load_history updated with the docs of this
+    build. The docs which weren't parsed, as they were skipped, resumed or
+    found in the parse cache, keep what an older build measured.
+    """
+    history = dict(history)
+    for name, counters in docs.items():
+        size, seconds = history.get(name, (None, None))
+        history[name] = (counters.get('bytes', size),
+                         counters.get('parse', seconds))
+    return history
+
+
+def schedule(docs, history):
+    """
+    Order docs longest first, so that no big doc starts last while the
+    other workers are idle. A doc's cost is its parse time in the last
+    build which parsed it, or else its size, converted to parse time at
+    the average rate of the history if there is one.
+    """
+    sizes = [size for size, seconds in history.values() if size and seconds]
+    seconds = [seconds for size, seconds in history.values()
+               if size and seconds]
+    rate = sum(seconds) / sum(sizes) if sizes else None
+
+    def cost(doc):
+        doc = doc.copy()
+        doc.reassign_name()
+        size, seconds = history.get(doc.name, (None, None))
+        if seconds:
+            return seconds
+        if not size:
+            size = SIZE_HINTS.get(doc.name, DEFAULT_SIZE_HINT) * 1024
+        return size * rate if rate else size
+
+    return sorted(docs, key=cost, reverse=True)
+
+
+class SessionTransport(object):
+    """
+    Default transport of Pipeline: run the blocking methods of fetcher,
+    which share its session and cache, in a thread pool. Resources are
+    downloaded through `store` if given.
+    Any object providing the same coroutines and close() can be plugged
+    into Pipeline instead.
+    """
+
+    def __init__(self, fetcher, store=None, threads=fetch_threads()):
+        self.fetcher = fetcher
+        self.store = store
+        self.executor = ThreadPoolExecutor(max_workers=threads)
+
+    async def get_text(self, url):
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self.executor,
+                                          self.fetcher.get_text, url)
+
+    async def download(self, resource, path):
+        loop = asyncio.get_event_loop()
+        await loop.run_in_executor(self.executor, download_resource, resource,
+                                   path, self.fetcher, self.store)
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+
+
+class Pipeline(object):
+    """
+    Handle docs in the given order with `concurrency` workers, each of
+    which fetches a doc, parses it in one of `parse_jobs` processes, so
+    parsing isn't serialized by the GIL, and writes it into the docset of
+    `build`, a DocsetBuild. Each doc is given `timeout` seconds, so a slow
+    doc fails on its own instead of stalling the others.
+    Resources are downloaded as soon as a parsed doc refers to them, and
+    each url only once.
+    With `split`, each entry gets its own page, see split_doc, and with
+    `compact` pages are compacted, see compact_page.
+    """
+
+    def __init__(self,
+                 build,
+                 concurrency=CONCURRENCY,
+                 timeout=900,
+                 transport=None,
+                 parse_jobs=None,
+                 parser='html.parser',
+                 writer=None,
+                 split=False,
+                 compact=False):
+        self.build = build
+        self.path = build.paths.documents
+        self.stats = build.stats
+        self.concurrency = concurrency
+        self.parser = parser
+        self.split = split
+        self.compact = compact
+        self.writer = writer
+        self.timeout = timeout
+        # docs and resources are fetched at the same time
+        self.transport = transport or SessionTransport(
+            build.fetcher, build.resource_store, fetch_threads(concurrency))
+        self.parse_executor = ProcessPoolExecutor(
+            max_workers=parse_jobs, initializer=ignore_interrupt)
+        # parsed docs are written out of the event loop
+        self.write_executor = ThreadPoolExecutor(max_workers=1)
+        # url => task downloading it
+        self.downloads = {}
+        # list of (url, exception)
+        self.failures = []
+
+    def run(self, docs):
+        try:
+            asyncio.run(self._run(docs))
+        finally:
+            self.transport.close()
+            self.parse_executor.shutdown(wait=True)
+            self.write_executor.shutdown(wait=True)
+        return not self.failures
+
+    async def _run(self, docs):
+        self.started = time.time()
+        self.resource_semaphore = asyncio.Semaphore(self.concurrency)
+        self.resource_tasks = []
+        pending = deque(docs)
+        await asyncio.gather(*(self._work(pending)
+                               for _ in range(self.concurrency)))
+        await asyncio.gather(*self.resource_tasks)
+
+    async def _work(self, pending):
+        while pending:
+            await self._handle_doc(pending.popleft())
+
+    async def _handle_doc(self, doc):
+        try:
+            await asyncio.wait_for(self._process(doc), self.timeout)
+        except Exception as e:
+            if isinstance(e, asyncio.TimeoutError):
+                message = 'Timeout after %ds' % self.timeout
+            else:
+                message = ''.join(traceback.format_exc())
+            info('Error happened when handling %s\n%s' % (doc.url, message))
+            self.failures.append((doc.url, e))
+
+    async def _process(self, doc):
+        stats = self.stats
+        doc.reassign_name()
+        resumed = resume_doc(doc, self.build)
+        if resumed is not None:
+            stats.set(stats.docs, doc.name, url=doc.url, resumed=True)
+            self._written(doc, *resumed)
+            return
+        stats.set(
+            stats.docs,
+            doc.name,
+            url=doc.url,
+            fetch_wait=time.time() - self.started)
+        info('Download Readme of %s' % doc.name)
+        with stats.span('fetch', stats.docs, doc.name, profile=False):
+            html = await self.transport.get_text(doc.url)
+        stats.set(stats.docs, doc.name, bytes=len(html.encode('utf-8')))
+        digest = check_doc(doc, html, self.build, self.parser, self.split,
+                           self.compact)
+        if digest is None:
+            stats.set(stats.docs, doc.name, skipped=True)
+            return
+        result = None
+        if self.build.parse_cache is not None:
+            result = self.build.parse_cache.get(digest)
+        if result is None:
+            info('Parse Readme of %s' % doc.name)
+            loop = asyncio.get_event_loop()
+            with stats.span('parse', stats.docs, doc.name, profile=False):
+                (entries, resources, pages, stylesheets, (before, after),
+                 profile) = await loop.run_in_executor(
+                     self.parse_executor, parse_in_process, html, doc.name,
+                     doc.url, doc.sections, self.parser,
+                     stats.profile == 'cprofile', self.split, self.compact)
+            if self.compact:
+                stats.add(stats.sizes, 'html', before=before, after=after)
+            if profile is not None:
+                stats.add_profile('parse', ProfileResult(profile))
+            result = ([Entry(*entry) for entry in entries],
+                      set(Resource(*res) for res in resources), pages,
+                      stylesheets)
+            if self.build.parse_cache is not None:
+                self.build.parse_cache.put(digest, result)
+        stats.set(stats.docs, doc.name, entries=len(result[0]))
+        loop = asyncio.get_event_loop()
+        await loop.run_in_executor(self.write_executor, save_doc, doc, digest,
+                                   result, self.build, self.compact)
+        self._written(doc, result[0], result[1])
+
+    def _written(self, doc, entries, resources):
+        if self.writer is not None:
+            self.writer.write(doc.name, entries)
+        for resource in resources:
+            self.resource_tasks.append(
+                asyncio.ensure_future(self._download(resource)))
+
+    async def _download(self, resource):
+        journal = self.build.journal
+        if journal is not None and journal.has_resource(resource, self.path):
+            return
+        # resources of the same url share the same file
+        task = self.downloads.get(resource.url)
+        if task is None:
+            task = asyncio.ensure_future(self._fetch_resource(resource))
+            self.downloads[resource.url] = task
+        await task
+
+    async def _fetch_resource(self, resource):
+        stats = self.stats
+        try:
+            queued_at = time.time()
+            async with self.resource_semaphore:
+                stats.set(stats.resources,
+                          resource.url,
+                          wait=time.time() - queued_at)
+                with stats.span('download', stats.resources, resource.url,
+                                profile=False):
+                    await self.transport.download(resource, self.path)
+            stats.set(
+                stats.resources,
+                resource.url,
+                bytes=os.path.getsize(self.path + resource.filename))
+            if self.build.journal is not None:
+                self.build.journal.add_resource(resource)
+        except Exception as e:
+            info('Error happened when downloading %s\n%s' %
+                 (resource.url, traceback.format_exc()))
+            self.failures.append((resource.url, e))
+
+
+def write_report(fn, build, profile_prefix=None, history=None):
+    """
+    Write the report of the build, with the history to schedule the next
+    one if given.
+    """
+    report = build.stats.report(connection_stats(build.fetcher.session))
+    if history is not None:
+        history = update_history(history, report['docs'])
+        report['history'] = dict((name, {
+            'bytes': size,
+            'parse': seconds
+        }) for name, (size, seconds) in history.items())
+    with open(fn, 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+    if profile_prefix is not None:
+        build.stats.dump_profiles(profile_prefix)
+
+
+def interrupt_handler(*args):
+    print(
+        "Interrupted, run with --resume to continue the build",
+        file=sys.stderr)
+    sys.exit(1)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Build OpenResty docset for dash/zeal.')
+    parser.add_argument(
+        '--cache-dir',
+        default='.cache',
+        help='where to keep downloaded responses between builds')
+    parser.add_argument(
+        '--cache-size',
+        type=int,
+        default=256,
+        help='max size of the response cache in MB')
+    parser.add_argument(
+        '--no-cache',
+        action='store_true',
+        help='always download everything from scratch')
+    parser.add_argument(
+        '--incremental',
+        action='store_true',
+        help='only regenerate the docs which changed since the last build')
+    parser.add_argument(
+        '--only',
+        action='append',
+        metavar='URL',
+        help='only fetch the doc at URL, can be repeated; the other docs of '
+        'the docset are kept as they are, so it implies --incremental')
+    parser.add_argument(
+        '--resume',
+        action='store_true',
+        help='continue an interrupted or failed build from its journal')
+    parser.add_argument(
+        '--concurrency',
+        type=int,
+        default=CONCURRENCY,
+        help='how many workers handle docs, and how many resources are '
+        'fetched at the same time')
+    parser.add_argument(
+        '--parse-jobs',
+        type=int,
+        default=None,
+        help='how many processes parse docs, the number of cores by default'
+    )
+    parser.add_argument(
+        '--parser',
+        choices=PARSERS,
+        default='html.parser',
+        help='html parser backend, the lxml ones need lxml installed')
+    parser.add_argument(
+        '--split',
+        action='store_true',
+        help='give each entry its own page, so opening it doesn\'t load the '
+        'whole doc')
+    parser.add_argument(
+        '--compact',
+        action='store_true',
+        help='minify the pages, strip GitHub\'s chrome and prune GitHub\'s '
+        'stylesheets into one with only the rules in use')
+    parser.add_argument(
+        '--releases',
+        help='JSON file mapping OpenResty releases to the tag or commit of '
+        'each repo they bundle, to build a docset for each release')
+    parser.add_argument(
+        '--release',
+        action='append',
+        help='only build the docset of this release in RELEASES, can be '
+        'repeated')
+    parser.add_argument(
+        '--upstream',
+        help='fetch every url from UPSTREAM/host/path instead, '
+        'e.g. a server started by `bench.py serve`')
+    parser.add_argument(
+        '--rate',
+        type=float,
+        default=RATE,
+        help='average requests per second sent by all fetchers')
+    parser.add_argument(
+        '--burst',
+        type=int,
+        default=None,
+        help='max requests sent at once, twice the concurrency by default')
+    parser.add_argument(
+        '--retries',
+        type=int,
+        default=RETRIES,
+        help='how many times to retry a failed or throttled request')
+    parser.add_argument(
+        '--report',
+        default='build-report.json',
+        help='where to write the JSON report of the build')
+    parser.add_argument(
+        '--profile',
+        choices=('cprofile', 'tracemalloc'),
+        help='profile each stage of the build, the results are added to the '
+        'report, and with cprofile also dumped as REPORT.STAGE.pstats')
+    parser.add_argument(
+        '--timeout',
+        type=int,
+        default=900,
+        help='seconds allowed to fetch and parse each doc')
+    return parser.parse_args()
+
+
+def build_docset(args,
+                 release,
+                 docs,
+                 fetcher,
+                 parse_cache=None,
+                 resource_store=None):
+    """
+    Build the docset of the release, or the default one if it is None,
+    with the options in args. Exit with 1 if some docs failed.
+    """
+    report = args.report
+    paths = DocsetPaths()
+    if release is not None:
+        paths = DocsetPaths('OpenResty-%s.docset' % release)
+        name, ext = os.path.splitext(args.report)
+        report = '%s-%s%s' % (name, release, ext)
+        info('Build %s' % paths.docset)
+    stats = BuildStats(args.profile)
+    journal = Journal(
+        paths.journal,
+        options={
+            'incremental': args.incremental,
+            'parser': args.parser,
+            'split': args.split,
+            'compact': args.compact,
+            'upstream': args.upstream,
+        },
+        resume=args.resume and os.path.isdir(paths.staging))
+    if args.resume and not journal.resumed:
+        info('Nothing to resume, start a new build')
+    build_docset_structure(paths, args.incremental, journal.resumed, release)
+    manifest = Manifest(paths.manifest, load=args.incremental)
+    build = DocsetBuild(paths, fetcher, stats, manifest, journal, parse_cache,
+                        resource_store)
+    writer = IndexWriter(paths.index, replace=args.incremental, stats=stats)
+    writer.start()
+    for name in manifest.forget_except(set(doc.url for doc in docs)):
+        writer.write(name, [])
+    if args.only:
+        docs = [doc for doc in docs if doc.url in args.only]
+    history = load_history(report)
+    docs = schedule(docs, history)
+    pipeline = Pipeline(
+        build,
+        concurrency=args.concurrency,
+        timeout=args.timeout,
+        parse_jobs=args.parse_jobs,
+        parser=args.parser,
+        writer=writer,
+        split=args.split,
+        compact=args.compact)
+    succeeded = pipeline.run(docs)
+    writer.close()
+    if not succeeded:
+        write_report(report, build, history=history)
+        print(
+            "Failed to download some documents, exit with 1. "
+            "Run with --resume to retry them",
+            file=sys.stderr)
+        sys.exit(1)
+    if args.compact:
+        with stats.span('compact_stylesheet'):
+            sizes = compact_stylesheet(paths.documents,
+                                       manifest.stylesheets())
+        if sizes is not None:
+            stats.add(stats.sizes, 'css', before=sizes[0], after=sizes[1])
+        for kind, sizes in sorted(stats.sizes.items()):
+            info('Compacted %s from %d to %d KB' %
+                 (kind, sizes['before'] // 1024, sizes['after'] // 1024))
+    elif os.path.isfile(paths.documents + STYLESHEET):
+        os.remove(paths.documents + STYLESHEET)
+    with stats.span('optimize_index'):
+        optimize_index(paths.index)
+    for fn in manifest.stale_files():
+        if os.path.isfile(paths.documents + fn):
+            os.remove(paths.documents + fn)
+        # the directory of a doc which isn't split any more
+        dirname = os.path.dirname(paths.documents + fn)
+        if os.path.isdir(dirname) and not os.listdir(dirname):
+            os.rmdir(dirname)
+    normalize_mtimes(paths.staging)
+    journal.close()
+    swap_docset(paths.staging, paths.docset)
+    # only once the docset it describes is in place, so an incremental
+    # build never skips a doc the docset doesn't have yet
+    manifest.save()
+    os.remove(paths.journal)
+    write_report(report, build, os.path.splitext(report)[0], history)
+
+
+def main():
+    args = parse_args()
+    if args.only:
+        args.incremental = True
+    if args.parser != 'html.parser':
+        try:
+            import lxml  # noqa: F401
+        except ImportError:
+            print("lxml not found, run `pip install lxml` to use %s parser" %
+                  args.parser)
+            sys.exit(1)
+    builds = [(None, DOCS)]
+    if args.releases:
+        try:
+            releases = load_releases(args.releases)
+        except (IOError, ValueError) as e:
+            print('Invalid %s: %s' % (args.releases, e))
+            sys.exit(1)
+        names = args.release or list(releases)
+        for release in names:
+            if release not in releases:
+                print('%s is not in %s' % (release, args.releases))
+                sys.exit(1)
+        builds = [(release, release_docs(releases[release]))
+                  for release in names]
+    http_cache = parse_cache = resource_store = None
+    if not args.no_cache:
+        http_cache = ResponseCache(
+            os.path.join(args.cache_dir, 'http'),
+            args.cache_size * 1024 * 1024)
+        parse_cache = ParseCache(os.path.join(args.cache_dir, 'parsed'))
+        resource_store = ResourceStore(
+            os.path.join(args.cache_dir, 'resources'))
+    signal.signal(signal.SIGINT, interrupt_handler)
+    fetcher = Fetcher(
+        create_session(fetch_threads(args.concurrency)),
+        cache=http_cache,
+        upstream=args.upstream,
+        rate_limiter=RateLimiter(
+            args.rate, args.burst or fetch_threads(args.concurrency)),
+        retries=args.retries)
+    # the docsets of releases are built one after the other, sharing the
+    # caches, so a page or resource used by several of them is fetched and
+    # parsed once
+    try:
+        for release, docs in builds:
+            build_docset(args, release, docs, fetcher, parse_cache,
+                         resource_store)
+    finally:
+        # also when interrupted, so what was fetched is kept for --resume
+        if http_cache is not None:
+            http_cache.save()
+        if resource_store is not None:
+            resource_store.save()
+    for host, (requests_num, connections) in sorted(
+            connection_stats(fetcher.session).items()):
+        info('%s: %d requests over %d connections' %
+             (host, requests_num, connections))
+
+
+if __name__ == '__main__':
+    main()
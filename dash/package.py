@@ -0,0 +1,266 @@
+#!/usr/bin/env python
+# coding: utf-8
+"""
+Package the OpenResty docset for a Dash feed.
+
+    ./package.py build    archive the docset, write its feed and the deltas
+                          from the previous versions
+    ./package.py apply    update an installed docset with a delta
+"""
+from __future__ import print_function
+import argparse
+import gzip
+import hashlib
+import io
+import json
+import os
+import re
+import shutil
+import sys
+import tarfile
+
+import openresty
+
+NAME = 'OpenResty'
+DOCSET = NAME + '.docset'
+
+
+def file_digests(path):
+    """Return {path relative to path: sha256} of every file under path."""
+    digests = {}
+    for root, _, files in os.walk(path):
+        for fn in files:
+            full = os.path.join(root, fn)
+            h = hashlib.sha256()
+            with open(full, 'rb') as f:
+                for chunk in iter(lambda: f.read(openresty.CHUNK_SIZE), b''):
+                    h.update(chunk)
+            digests[os.path.relpath(full, path)] = h.hexdigest()
+    return digests
+
+
+def content_version(digests):
+    """A version which only changes with the content of the docset."""
+    h = hashlib.sha256()
+    for name in sorted(digests):
+        h.update(('%s %s\n' % (name, digests[name])).encode('utf-8'))
+    return h.hexdigest()[:12]
+
+
+def write_archive(fn, root, digests, names, extra=None):
+    """
+    Stream a reproducible .tgz of `names` under root into fn: members are
+    sorted, owned by root with fixed modes and BUILD_MTIME, and files with
+    the same content as an earlier member are stored as hard links to it.
+    `extra` is {member name: bytes} added before the docset.
+    """
+    mtime = openresty.BUILD_MTIME
+
+    def member(name, type=tarfile.REGTYPE):
+        info = tarfile.TarInfo(name)
+        info.type = type
+        info.mtime = mtime
+        info.mode = 0o755 if type == tarfile.DIRTYPE else 0o644
+        return info
+
+    with open(fn + '.tmp', 'wb') as raw:
+        # no file name and a fixed time in the gzip header either
+        with gzip.GzipFile(
+                filename='', mode='wb', fileobj=raw, mtime=mtime) as gz:
+            archive = tarfile.open(
+                fileobj=gz, mode='w|', format=tarfile.GNU_FORMAT)
+            for name, content in sorted((extra or {}).items()):
+                info = member(name)
+                info.size = len(content)
+                archive.addfile(info, io.BytesIO(content))
+            dirs = set()
+            # sha256 => the first member with it
+            stored = {}
+            for name in sorted(names):
+                parts = name.split(os.sep)
+                for i in range(len(parts)):
+                    directory = '/'.join([DOCSET] + parts[:i])
+                    if directory not in dirs:
+                        dirs.add(directory)
+                        archive.addfile(member(directory, tarfile.DIRTYPE))
+                arcname = '/'.join([DOCSET] + parts)
+                digest = digests[name]
+                if digest in stored:
+                    info = member(arcname, tarfile.LNKTYPE)
+                    info.linkname = stored[digest]
+                    archive.addfile(info)
+                    continue
+                stored[digest] = arcname
+                full = os.path.join(root, name)
+                info = member(arcname)
+                info.size = os.path.getsize(full)
+                with open(full, 'rb') as f:
+                    archive.addfile(info, f)
+            archive.close()
+    os.rename(fn + '.tmp', fn)
+
+
+def feed_version(fn):
+    """Return the version in the feed fn, or None."""
+    try:
+        with open(fn) as f:
+            match = re.search(r'<version>([^<]+)</version>', f.read())
+    except IOError:
+        return None
+    return match.group(1) if match else None
+
+
+def write_feed(fn, version, url):
+    """
+    Replace the feed atomically, once the archive it points at is in place,
+    so Dash never reads a partial feed.
+    """
+    content = """<entry>
+    <version>{0}</version>
+    <url>{1}</url>
+</entry>
+""".format(version, url)
+    with open(fn + '.tmp', 'w') as f:
+        f.write(content)
+    os.rename(fn + '.tmp', fn)
+
+
+def build(args):
+    if not os.path.isdir(args.docset):
+        print('%s not found, run ./openresty.py first' % args.docset)
+        sys.exit(1)
+    if not os.path.isdir(args.out):
+        os.makedirs(args.out)
+    digests = file_digests(args.docset)
+    version = args.version or content_version(digests)
+    feed = os.path.join(args.out, NAME + '.xml')
+    previous = args.previous
+    if previous is None:
+        previous = [feed_version(feed)] if feed_version(feed) else []
+
+    # the file lists of each version, to make deltas from it later
+    with open(os.path.join(args.out, '%s-%s.json' % (NAME, version)),
+              'w') as f:
+        json.dump({'version': version, 'files': digests}, f, indent=1,
+                  sort_keys=True)
+    write_archive(
+        os.path.join(args.out, NAME + '.tgz'), args.docset, digests, digests)
+    print('%s.tgz: version %s, %d files' % (NAME, version, len(digests)))
+
+    for old_version in previous:
+        if old_version == version:
+            continue
+        with open(os.path.join(args.out,
+                               '%s-%s.json' % (NAME, old_version))) as f:
+            old = json.load(f)
+        changed = [
+            name for name, digest in digests.items()
+            if old['files'].get(name) != digest
+        ]
+        removed = sorted(set(old['files']) - set(digests))
+        delta = {
+            'from': old_version,
+            'to': version,
+            'removed': removed,
+            'files': digests,
+        }
+        fn = os.path.join(args.out,
+                          '%s-%s-%s.delta.tgz' % (NAME, old_version, version))
+        write_archive(
+            fn, args.docset, digests, changed, {
+                'delta.json':
+                json.dumps(delta, indent=1, sort_keys=True).encode('utf-8')
+            })
+        print('%s: %d changed, %d removed, %d bytes' %
+              (os.path.basename(fn), len(changed), len(removed),
+               os.path.getsize(fn)))
+
+    url = '%s/%s.tgz' % (args.base_url.rstrip('/'), NAME)
+    write_feed(feed, version, url)
+
+
+def apply(args):
+    """
+    Patch a copy of the docset with the delta, check that the result is
+    exactly the new version, then swap it into place.
+    """
+    docset = args.docset.rstrip('/')
+    work = docset + '.patching'
+    if os.path.isdir(work):
+        shutil.rmtree(work)
+    os.makedirs(work)
+    staging = os.path.join(work, DOCSET)
+    shutil.copytree(docset, staging)
+    with tarfile.open(args.delta, 'r:gz') as archive:
+        delta = json.load(archive.extractfile('delta.json'))
+        members = []
+        for info in archive.getmembers():
+            if info.name == 'delta.json':
+                continue
+            inside = info.name == DOCSET or info.name.startswith(DOCSET + '/')
+            if not inside or '..' in info.name.split('/'):
+                print('Unexpected file %s in the delta' % info.name)
+                sys.exit(1)
+            members.append(info)
+        if hasattr(tarfile, 'data_filter'):
+            archive.extractall(work, members, filter='data')
+        else:
+            archive.extractall(work, members)
+    for name in delta['removed']:
+        fn = os.path.join(staging, name)
+        if os.path.isfile(fn):
+            os.remove(fn)
+            try:
+                os.removedirs(os.path.dirname(fn))
+            except OSError:
+                # not empty
+                pass
+    if file_digests(staging) != delta['files']:
+        shutil.rmtree(work)
+        print('%s is not version %s, download the whole docset instead' %
+              (docset, delta['from']))
+        sys.exit(1)
+    openresty.swap_docset(staging, docset)
+    shutil.rmtree(work)
+    print('Updated %s from %s to %s' % (docset, delta['from'], delta['to']))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Package the OpenResty docset for a Dash feed.')
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+
+    build_parser = commands.add_parser(
+        'build',
+        help='archive the docset, write its feed and the deltas from the '
+        'previous versions')
+    build_parser.add_argument('--docset', default=DOCSET)
+    build_parser.add_argument(
+        '--out', default='dist', help='where the packages are written')
+    build_parser.add_argument(
+        '--base-url',
+        default='https://example.com/docsets',
+        help='where the packages are published, used in the feed')
+    build_parser.add_argument(
+        '--version',
+        help='version in the feed, a digest of the content by default')
+    build_parser.add_argument(
+        '--previous',
+        nargs='*',
+        help='versions to make deltas from, the version in the current '
+        'feed by default')
+    build_parser.set_defaults(func=build)
+
+    apply_parser = commands.add_parser(
+        'apply', help='update an installed docset with a delta')
+    apply_parser.add_argument('delta')
+    apply_parser.add_argument('docset', nargs='?', default=DOCSET)
+    apply_parser.set_defaults(func=apply)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
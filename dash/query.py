@@ -0,0 +1,267 @@
+#!/usr/bin/env python
+# coding: utf-8
+"""
+Look up OpenResty APIs in the docset index, for editors and bots.
+
+    index = DocsetIndex('OpenResty.docset')
+    index.lookup('ngx.say')         exact and prefix matches
+    index.lookup('lock:new')        a method of a module
+    index.lookup('ngx.say(stream-lua-nginx-module)')
+                                    in one doc, as Dash names duplicates
+    index.fuzzy('ngxreqgh')         subsequence matches
+
+The index is read once into memory and reloaded when the docset is rebuilt.
+"""
+from __future__ import print_function
+from bisect import bisect_left, bisect_right
+from collections import namedtuple
+from heapq import nsmallest
+from threading import Lock
+import argparse
+import json
+import os
+import re
+import sqlite3
+import sys
+import time
+
+INDEX = 'Contents/Resources/docSet.dsidx'
+
+# `name` is the entry's name without the '(doc)' suffix which
+# openresty.mark_duplicate_entries gives to names shared by several docs,
+# `anchor` the fragment of `path`, None for the page of a split doc.
+Match = namedtuple('Match', ['name', 'type', 'path', 'doc', 'anchor'])
+
+
+def doc_of(path):
+    """
+    The doc of an entry is the part of its path before '.html', or before '/'
+    for the pages of split docs, as in openresty.mark_duplicate_entries.
+    """
+    end = path.replace('/', '.html').find('.html')
+    return path[:end] if end >= 0 else path
+
+
+def strip_doc(name, doc):
+    """Return name without its '(doc)' suffix."""
+    suffix = '(%s)' % doc
+    if name.endswith(suffix) and len(name) > len(suffix):
+        return name[:-len(suffix)]
+    return name
+
+
+def split_query(text):
+    """Return (name, doc) of a query, which may end with '(doc)'."""
+    match = re.match(r'^(.+)\(([\w.-]+)\)$', text.strip())
+    if match is None:
+        return text.strip(), None
+    return match.group(1), match.group(2)
+
+
+class Snapshot(object):
+    """
+    The entries of one version of the index. Entries are sorted by name,
+    and each of them is found by the sorted lower case keys: its whole name
+    and the last part after ':' or '.', e.g. 'lock:new' and 'new'. The keys
+    are also joined in one string, so fuzzy lookups run in the regex engine.
+    """
+
+    def __init__(self, rows):
+        types = {}
+        entries = []
+        for name, type, path in rows:
+            doc = doc_of(path)
+            entries.append(
+                Match(
+                    strip_doc(name, doc),
+                    # one string for each type
+                    types.setdefault(type, type),
+                    path,
+                    doc,
+                    path.partition('#')[2] or None))
+        entries.sort(key=lambda entry: (entry.name.lower(), entry.doc))
+        self.entries = entries
+        keys = []
+        for i, entry in enumerate(entries):
+            key = entry.name.lower()
+            keys.append((key, i))
+            last = re.split(r'[:.]', key)[-1]
+            if last != key:
+                keys.append((last, i))
+        keys.sort()
+        self.keys = [key for key, _ in keys]
+        self.ids = [i for _, i in keys]
+        self.text = '\n'.join(self.keys)
+        # offset of each key in text
+        self.offsets = []
+        offset = 0
+        for key in self.keys:
+            self.offsets.append(offset)
+            offset += len(key) + 1
+
+    def prefixed(self, prefix):
+        """Yield the ids of the entries with a key starting with prefix."""
+        start = bisect_left(self.keys, prefix)
+        end = bisect_right(self.keys, prefix + '\uffff', start)
+        for i in range(start, end):
+            yield self.ids[i]
+
+    def fuzzy(self, text):
+        """
+        Yield (score, id) of the entries with a key containing the letters
+        of text in order, the lower the score the closer the match.
+        """
+        # each letter is matched by skipping anything but itself, so the
+        # regex engine never backtracks
+        pattern = re.escape(text[0]) + ''.join(
+            '[^\n%s]*%s' % (re.escape(c), re.escape(c)) for c in text[1:])
+        for match in re.finditer(pattern, self.text):
+            i = bisect_right(self.offsets, match.start()) - 1
+            yield (match.end() - match.start(), len(self.keys[i])), self.ids[i]
+
+
+class DocsetIndex(object):
+    """
+    In-memory index of the entries of a docset. The docset is replaced as
+    a whole by each build, so it is reloaded, at most every
+    `check_interval` seconds, when its index is a different file. All
+    files of a docset share the same mtime, and an inode is reused once
+    the previous docset is removed, so the ctime, which every build sets
+    when it normalizes the mtimes, counts too. Lookups may run in several
+    threads.
+    """
+
+    def __init__(self, path='OpenResty.docset', check_interval=1.0):
+        if os.path.isdir(path):
+            path = os.path.join(path, INDEX)
+        self.path = path
+        self.check_interval = check_interval
+        self.lock = Lock()
+        self.snapshot = None
+        self.version = None
+        self.checked_at = 0
+        self._refresh()
+
+    def _refresh(self):
+        now = time.time()
+        if self.snapshot is not None and (now - self.checked_at <
+                                          self.check_interval):
+            return self.snapshot
+        with self.lock:
+            self.checked_at = now
+            try:
+                st = os.stat(self.path)
+            except OSError:
+                if self.snapshot is None:
+                    raise
+                # being swapped by a build where the swap isn't atomic
+                return self.snapshot
+            version = (st.st_ino, st.st_size, st.st_mtime, st.st_ctime_ns)
+            if version != self.version:
+                db = sqlite3.connect('file:%s?mode=ro' % self.path, uri=True)
+                try:
+                    rows = db.execute(
+                        'SELECT name, type, path FROM searchIndex').fetchall()
+                finally:
+                    db.close()
+                self.snapshot = Snapshot(rows)
+                self.version = version
+        return self.snapshot
+
+    def __len__(self):
+        return len(self._refresh().entries)
+
+    def _filter(self, snapshot, ids, doc, types):
+        for i in ids:
+            entry = snapshot.entries[i]
+            if doc is not None and entry.doc != doc:
+                continue
+            if types and entry.type not in types:
+                continue
+            yield entry
+
+    def prefix(self, text, limit=20, types=None):
+        """
+        Return the entries with a name, or a last part of the name after
+        ':' or '.', starting with text, exact matches and shorter names
+        first. `module:method` matches the methods of that module, with
+        the module as the end of its name, e.g. 'resty.lock:new'.
+        """
+        snapshot = self._refresh()
+        name, doc = split_query(text)
+        key = name.lower()
+        found = set(snapshot.prefixed(key))
+        module, _, method = key.rpartition(':')
+        if not found and module:
+            # resty.lock:new is lock:new
+            module = re.split(r'[.:]', module)[-1]
+            found = set(snapshot.prefixed('%s:%s' % (module, method)))
+        return nsmallest(
+            limit, self._filter(snapshot, found, doc, types),
+            lambda entry: (entry.name.lower() != key, len(entry.name),
+                           entry.name, entry.doc))
+
+    def fuzzy(self, text, limit=20, types=None):
+        """
+        Return the entries with a name containing the letters of text in
+        order, the most compact matches first.
+        """
+        snapshot = self._refresh()
+        name, doc = split_query(text)
+        if not name:
+            return []
+        best = {}
+        for score, i in snapshot.fuzzy(name.lower()):
+            if i not in best or score < best[i]:
+                best[i] = score
+        entries = self._filter(snapshot, sorted(best, key=best.get), doc,
+                               types)
+        return [entry for entry, _ in zip(entries, range(limit))]
+
+    def lookup(self, text, limit=20, types=None):
+        """Prefix matches of text, then fuzzy ones if there are too few."""
+        entries = self.prefix(text, limit, types)
+        if len(entries) < limit:
+            for entry in self.fuzzy(text, limit, types):
+                if len(entries) >= limit:
+                    break
+                if entry not in entries:
+                    entries.append(entry)
+        return entries
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Look up entries in the OpenResty docset.')
+    parser.add_argument('query', nargs='+')
+    parser.add_argument(
+        '--docset', default='OpenResty.docset', help='docset or its dsidx')
+    parser.add_argument('--limit', type=int, default=20)
+    parser.add_argument(
+        '--type', action='append', help='only entries of this type')
+    parser.add_argument(
+        '--fuzzy', action='store_true', help='only fuzzy matches')
+    parser.add_argument(
+        '--json', action='store_true', help='print a JSON object per entry')
+    args = parser.parse_args()
+
+    index = DocsetIndex(args.docset)
+    for query in args.query:
+        start = time.time()
+        if args.fuzzy:
+            entries = index.fuzzy(query, args.limit, args.type)
+        else:
+            entries = index.lookup(query, args.limit, args.type)
+        seconds = time.time() - start
+        for entry in entries:
+            if args.json:
+                print(json.dumps(entry._asdict()))
+            else:
+                print('%s\t%s\t%s' % (entry.name, entry.type, entry.path))
+        if not args.json:
+            print('%d entries in %.3f ms' % (len(entries), seconds * 1000),
+                  file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,416 @@
+#!/usr/bin/env python
+# coding: utf-8
+"""
+Keep the OpenResty docset up to date.
+
+Poll the head commit of each repo in DOCS and only rebuild the docs of the
+repos which moved, with `openresty.py --only`. Each finished build is
+swapped in for the docset, in one atomic step on Linux and macOS, see
+openresty.swap_docset, and with --publish is packaged for the feed by
+package.py.
+"""
+from __future__ import print_function
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from threading import Condition, Event, Lock, Thread
+import argparse
+import json
+import os
+import signal
+import subprocess
+import sys
+import time
+import traceback
+
+try:
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+except ImportError:
+    print("watch.py requires Python 3.7+")
+    sys.exit(1)
+
+import openresty
+from openresty import info
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+class GitHubHeads(object):
+    """
+    Default source of head commits: GET `url`, a template of repo and ref,
+    with `fetcher`, an openresty.Fetcher, so the requests go to --upstream
+    and share its rate limit. The bare sha is asked for, which GitHub
+    answers without the whole commit, and revalidated with its ETag, which
+    costs nothing against GitHub's rate limit while the head doesn't move.
+    The JSON of the commit is accepted too.
+    Any object with a head(repo, ref) method returning the commit, and
+    optionally a save() method called after each poll, can be plugged into
+    Watcher instead.
+    """
+
+    headers = {'Accept': 'application/vnd.github.sha'}
+
+    def __init__(self, fetcher, url=openresty.HEAD_URL):
+        self.fetcher = fetcher
+        self.url = url
+
+    def head(self, repo, ref):
+        text = self.fetcher.get_text(
+            self.url.format(repo=repo, ref=ref), self.headers)
+        try:
+            return json.loads(text)['sha']
+        except (ValueError, KeyError, TypeError):
+            return text.strip()
+
+    def save(self):
+        """Keep the ETags of the heads for a restarted watcher."""
+        if self.fetcher.cache is not None:
+            self.fetcher.cache.save()
+
+
+class Summary(object):
+    """Count, sum and last value of an observed duration."""
+
+    def __init__(self):
+        self.count = 0
+        self.sum = 0.0
+        self.last = None
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        self.last = value
+
+
+class Watcher(object):
+    """
+    Poll the head of each ref of a repo every `interval` seconds in one
+    thread, queue the docs of the refs which moved, and rebuild the queued
+    docs in batches in another. The heads of the built docs are saved in
+    `state`, so a restarted watcher only rebuilds what moved meanwhile.
+    `build` and `publish` are the commands run for each batch, the urls of
+    the docs are appended to `build` as --only arguments.
+    """
+
+    def __init__(self,
+                 source,
+                 build,
+                 publish=None,
+                 state='heads.json',
+                 interval=300,
+                 poll_jobs=openresty.CONCURRENCY,
+                 docs=openresty.DOCS):
+        self.source = source
+        self.build_cmd = build
+        self.publish_cmd = publish
+        self.state = state
+        self.interval = interval
+        self.poll_jobs = poll_jobs
+        # (repo, ref) => docs
+        self.repos = OrderedDict()
+        for doc in docs:
+            self.repos.setdefault((doc.repo, doc.ref), []).append(doc)
+        # (repo, ref) => head of the last build of its docs
+        self.heads = {}
+        if os.path.isfile(state):
+            with open(state) as f:
+                for key, head in json.load(f).items():
+                    repo, at, ref = key.partition('@')
+                    # the repo alone in older states, which is rebuilt
+                    if at:
+                        self.heads[(repo, ref)] = head
+        # (repo, ref) => the latest head polled
+        self.seen = dict(self.heads)
+        self.lock = Lock()
+        self.cond = Condition(self.lock)
+        # url => (doc, (repo, ref), head, when the head moved)
+        self.queue = OrderedDict()
+        self.stopped = Event()
+        self.child = None
+        self.building = 0
+        self.polls = 0
+        self.poll_errors = 0
+        self.builds = {'succeeded': 0, 'failed': 0}
+        self.build_seconds = Summary()
+        # from a head moving to its docs being published
+        self.update_latency = Summary()
+        self.published_at = None
+
+    def _head(self, repo, ref):
+        try:
+            return self.source.head(repo, ref)
+        except Exception:
+            info('Error happened when polling %s@%s\n%s' %
+                 (repo, ref, traceback.format_exc()))
+            with self.lock:
+                self.poll_errors += 1
+            return None
+
+    def poll(self):
+        """Queue the docs of the refs whose head moved."""
+        with ThreadPoolExecutor(max_workers=self.poll_jobs) as executor:
+            heads = list(
+                executor.map(lambda key: self._head(*key), self.repos))
+        if hasattr(self.source, 'save'):
+            self.source.save()
+        now = time.time()
+        with self.cond:
+            self.polls += 1
+            for key, head in zip(self.repos, heads):
+                if head is None or head == self.seen.get(key):
+                    continue
+                info('%s@%s moved to %s' % (key + (head, )))
+                self.seen[key] = head
+                for doc in self.repos[key]:
+                    queued = self.queue.get(doc.url)
+                    # latency counts from the first move not built yet
+                    moved_at = queued[3] if queued is not None else now
+                    self.queue[doc.url] = (doc, key, head, moved_at)
+            self.cond.notify()
+
+    def poll_forever(self):
+        while not self.stopped.is_set():
+            self.poll()
+            self.stopped.wait(self.interval)
+
+    def _run(self, cmd):
+        info('Run %s' % ' '.join(cmd))
+        self.child = subprocess.Popen(cmd)
+        try:
+            return self.child.wait() == 0
+        finally:
+            self.child = None
+
+    def build_batch(self):
+        """
+        Rebuild and publish the queued docs, return False if the build
+        failed, in which case the docs are queued again.
+        """
+        with self.cond:
+            batch = self.queue
+            self.queue = OrderedDict()
+            self.building = len(batch)
+        cmd = list(self.build_cmd)
+        if os.path.isdir(openresty.DocsetPaths().staging):
+            # left by a failed or interrupted build
+            cmd.append('--resume')
+        for url in batch:
+            cmd += ['--only', url]
+        start = time.time()
+        succeeded = self._run(cmd)
+        if succeeded and self.publish_cmd is not None:
+            succeeded = self._run(self.publish_cmd)
+        now = time.time()
+        with self.cond:
+            self.building = 0
+            self.build_seconds.observe(now - start)
+            if not succeeded:
+                self.builds['failed'] += 1
+                for url, item in batch.items():
+                    # keep the head polled during the build if there is one
+                    self.queue.setdefault(url, item)
+                info('Failed to update %d docs, retry with the next poll' %
+                     len(batch))
+                return False
+            self.builds['succeeded'] += 1
+            self.published_at = now
+            for doc, key, head, moved_at in batch.values():
+                self.heads[key] = head
+                self.update_latency.observe(now - moved_at)
+            with open(self.state + '.tmp', 'w') as f:
+                json.dump(
+                    dict(('%s@%s' % key, head)
+                         for key, head in self.heads.items()),
+                    f,
+                    indent=1,
+                    sort_keys=True)
+            os.rename(self.state + '.tmp', self.state)
+        info('Updated %d docs in %.1fs' % (len(batch), now - start))
+        return True
+
+    def build_forever(self):
+        while True:
+            with self.cond:
+                while not self.queue and not self.stopped.is_set():
+                    self.cond.wait()
+                if self.stopped.is_set():
+                    return
+            if not self.build_batch():
+                # retry with the next poll
+                self.stopped.wait(self.interval)
+
+    def stop(self, *args):
+        with self.cond:
+            self.stopped.set()
+            self.cond.notify_all()
+        child = self.child
+        if child is not None:
+            # openresty.py stops where --resume can continue
+            child.send_signal(signal.SIGINT)
+
+    def metrics(self):
+        """Return the metrics in the Prometheus text format."""
+        lines = []
+
+        def add(name, kind, help, samples):
+            lines.append('# HELP openresty_watch_%s %s' % (name, help))
+            lines.append('# TYPE openresty_watch_%s %s' % (name, kind))
+            for suffix, value in samples:
+                if value is not None:
+                    lines.append('openresty_watch_%s%s %s' %
+                                 (name, suffix, value))
+
+        with self.lock:
+            add('queue_depth', 'gauge', 'Docs waiting to be rebuilt.',
+                [('', len(self.queue))])
+            add('building', 'gauge', 'Docs being rebuilt.',
+                [('', self.building)])
+            add('polls_total', 'counter', 'Polls of all repos.',
+                [('', self.polls)])
+            add('poll_errors_total', 'counter', 'Failed polls of a repo.',
+                [('', self.poll_errors)])
+            add('builds_total', 'counter', 'Builds by result.',
+                [('{result="%s"}' % result, count)
+                 for result, count in sorted(self.builds.items())])
+            for name, summary, help in (
+                ('build_duration_seconds', self.build_seconds,
+                 'Time to rebuild and publish a batch of docs.'),
+                ('update_latency_seconds', self.update_latency,
+                 'Time from a repo moving to its docs being published.'),
+            ):
+                add(name, 'summary', help, [('_sum', summary.sum),
+                                            ('_count', summary.count)])
+                add('last_' + name, 'gauge', help, [('', summary.last)])
+            add('last_publish_timestamp_seconds', 'gauge',
+                'When the docset was last published.',
+                [('', self.published_at)])
+        return '\n'.join(lines) + '\n'
+
+
+def serve_metrics(watcher, port):
+    """Serve the metrics of watcher at /metrics in a background thread."""
+
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            if self.path != '/metrics':
+                self.send_response(404)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            body = watcher.metrics().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    server = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+    server.daemon_threads = True
+    thread = Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Rebuild the docs of the OpenResty repos which moved, '
+        'as soon as they move.')
+    parser.add_argument(
+        '--interval',
+        type=float,
+        default=300,
+        help='seconds between two polls of the repos')
+    parser.add_argument(
+        '--once',
+        action='store_true',
+        help='poll once, rebuild what moved and exit')
+    parser.add_argument(
+        '--cache-dir',
+        default='.cache',
+        help='cache shared with openresty.py, where the polled heads are '
+        'kept too')
+    parser.add_argument(
+        '--upstream',
+        help='poll and build from UPSTREAM/host/path instead, e.g. a server '
+        'started by `bench.py serve`')
+    parser.add_argument(
+        '--heads',
+        default=openresty.HEAD_URL,
+        help='template of the url answering the head commit of {repo} at '
+        '{ref}, as JSON with a sha or the bare sha')
+    parser.add_argument(
+        '--poll-jobs',
+        type=int,
+        default=openresty.CONCURRENCY,
+        help='how many repos are polled at the same time')
+    parser.add_argument(
+        '--metrics-port',
+        type=int,
+        help='serve the metrics at http://127.0.0.1:PORT/metrics')
+    parser.add_argument(
+        '--publish',
+        metavar='DIR',
+        help='package each updated docset and its feed into DIR with '
+        'package.py')
+    parser.add_argument(
+        '--base-url',
+        default='https://example.com/docsets',
+        help='where the packages are published, used in the feed')
+    parser.add_argument(
+        'build_args',
+        nargs=argparse.REMAINDER,
+        help='arguments passed to openresty.py, after --')
+    args = parser.parse_args()
+    if args.build_args and args.build_args[0] == '--':
+        args.build_args = args.build_args[1:]
+
+    fetcher = openresty.Fetcher(
+        openresty.create_session(args.poll_jobs),
+        # not the build's cache, which openresty.py writes at the same time
+        cache=openresty.ResponseCache(
+            os.path.join(args.cache_dir, 'heads'), 16 * 1024 * 1024),
+        upstream=args.upstream)
+    build = [
+        sys.executable,
+        os.path.join(HERE, 'openresty.py'), '--cache-dir', args.cache_dir
+    ]
+    if args.upstream:
+        build += ['--upstream', args.upstream]
+    build += args.build_args
+    publish = None
+    if args.publish:
+        publish = [
+            sys.executable,
+            os.path.join(HERE, 'package.py'), 'build', '--docset',
+            openresty.DOCSET_PATH, '--out', args.publish, '--base-url',
+            args.base_url
+        ]
+    watcher = Watcher(
+        GitHubHeads(fetcher, args.heads), build, publish,
+        os.path.join(args.cache_dir, 'heads.json'), args.interval,
+        args.poll_jobs)
+    if args.metrics_port is not None:
+        serve_metrics(watcher, args.metrics_port)
+
+    if args.once:
+        watcher.poll()
+        if watcher.queue and not watcher.build_batch():
+            sys.exit(1)
+        return
+    signal.signal(signal.SIGINT, watcher.stop)
+    signal.signal(signal.SIGTERM, watcher.stop)
+    poller = Thread(target=watcher.poll_forever, name='Poller')
+    poller.daemon = True
+    poller.start()
+    builder = Thread(target=watcher.build_forever, name='Builder')
+    builder.start()
+    # signals are only handled in the main thread, which mustn't block
+    while builder.is_alive():
+        builder.join(1)
+
+
+if __name__ == '__main__':
+    main()